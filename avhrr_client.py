@@ -0,0 +1,60 @@
+import os
+import sys
+import json
+import socket
+import argparse
+
+
+# the flags the server applies per request, see request_flags in avhrr_metadata_parser.py
+request_flags = ["d", "O", "f", "r", "l"]
+
+
+def setup_cmd_args():
+    """Setup command line arguments, the ones of avhrr_metadata_parser.py that matter to the client."""
+    parser = argparse.ArgumentParser(description="Thin client of avhrr_metadata_parser.py --serve. Takes the same arguments as the parser and prints the same metadata block.")
+    parser.add_argument("--output", help="Output folder of the server, where its socket lives")
+    parser.add_argument("--socket", help="Unix socket of the server (default: OUTPUT/avhrr_parser.sock)")
+    parser.add_argument("--noaa_mtd", help="Ignored, the server keeps its own catalogue")
+    parser.add_argument("--avhrr_file", help="The avhrr file path to process")
+    parser.add_argument("--ds", help="The dataset name for the avhrr file")
+    for flag in request_flags:
+        parser.add_argument("-" + flag, action='store_true', help="As for avhrr_metadata_parser.py")
+    return parser.parse_known_args()
+
+
+def request_metadata(socket_path, avhrr_file, ds=None, flags={}):
+    client = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    client.connect(socket_path)
+    with client:
+        client.sendall((json.dumps({"avhrr_file": avhrr_file, "ds": ds, "flags": flags}) + "\n").encode("utf8"))
+        response = b""
+        for chunk in iter(lambda: client.recv(1 << 16), b""):
+            response += chunk
+    return response.decode("utf8")
+
+
+def run_parser():
+    # do the work in-process like before
+    parser = os.path.join(os.path.dirname(os.path.abspath(__file__)), "avhrr_metadata_parser.py")
+    os.execv(sys.executable, [sys.executable, parser] + sys.argv[1:])
+
+
+if __name__ == '__main__':
+    args, unknown = setup_cmd_args()
+    if unknown or args.avhrr_file == None:
+        # other modes and flags are only served by the parser itself
+        run_parser()
+    socket_path = args.socket or os.path.join(args.output or ".", "avhrr_parser.sock")
+    flags = dict((flag, getattr(args, flag)) for flag in request_flags)
+    try:
+        response = request_metadata(socket_path, args.avhrr_file, args.ds, flags)
+    except OSError:
+        # no server running
+        run_parser()
+    if response.startswith("unsupported="):
+        run_parser()
+    if response.startswith("error="):
+        # stdout only carries metadata, like the parser's own failures
+        sys.stderr.write(response)
+        sys.exit(1)
+    sys.stdout.write(response)
@@ -1,13 +1,168 @@
 import os
-import subprocess
 import shutil
 import argparse
 import csv
 import re
 import datetime
 import logging
+import sqlite3
+import hashlib
+import json
 import tarfile
 import zipfile
+import signal
+import threading
+import socket
+import socketserver
+import http.server
+import functools
+import sys
+import time
+import errno
+import fcntl
+import gzip
+import concurrent.futures
+import collections
+import zlib
+import multiprocessing
+import logging.handlers
+import queue
+import contextlib
+import heapq
+import tempfile
+import codecs
+import ftplib
+import urllib.parse
+import urllib.request
+import urllib.error
+
+
+zipped = [".tar", ".tgz", ".tar.gz", ".zip"]
+level_patterns = [re.compile(rb"LEVEL [0-1][AB_]"), re.compile(rb"L[0-1][AB_]")]
+searchfiles = ['catalogue.ief', 'catalogue.iuf', 'LEADER']
+# a folder holding a file with one of these in its name is an avhrr product
+product_markers = [".l1a", "IMAGE", ".dat"] #, "LEADER"]
+# cheapest first, rename is only used when the source may be removed (-r)
+transfer_methods = ["auto", "rename", "hardlink", "reflink", "copy_file_range", "copy"]
+output_formats = ["kv", "jsonl", "csv", "tsv"]
+checksum_algorithms = ["md5", "sha1", "sha256", "sha512", "blake2b"]
+output_fields = ["product", "dataset", "acquisition_station", "start_orbit_number", "size", "start_time", "stop_time", "footprint"]
+# the processing level is written in the first records of the level files
+header_bytes = 64 * 1024
+epoch = datetime.datetime(1970, 1, 1)
+# sorted run files merged at once by --batch_join
+merge_fan_in = 64
+
+
+class RunMetrics:
+    """Wall/CPU time per stage and I/O and outcome counters of a run. Stage times
+    are inclusive, so nested stages (size_walk inside inspect) count in both."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        self.stages = {}
+        self.counters = collections.Counter()
+
+    def add_stage(self, name, calls, wall, cpu):
+        with self.lock:
+            totals = self.stages.setdefault(name, [0, 0.0, 0.0])
+            totals[0] += calls
+            totals[1] += wall
+            totals[2] += cpu
+
+    @contextlib.contextmanager
+    def stage(self, name):
+        wall, cpu = time.perf_counter(), time.thread_time()
+        try:
+            yield
+        finally:
+            self.add_stage(name, 1, time.perf_counter() - wall, time.thread_time() - cpu)
+
+    def count(self, name, n=1):
+        with self.lock:
+            self.counters[name] += n
+
+    def count_outcome(self, outcome):
+        self.count("products_" + re.sub('[^a-z0-9]+', '_', outcome.lower()).strip('_'))
+
+    def drain(self):
+        '''Return the metrics gathered so far and start again, for worker processes.'''
+        with self.lock:
+            snapshot = (self.stages, dict(self.counters))
+            self.reset()
+        return snapshot
+
+    def merge(self, snapshot):
+        stages, counters = snapshot
+        for name, (calls, wall, cpu) in stages.items():
+            self.add_stage(name, calls, wall, cpu)
+        for name, n in counters.items():
+            self.count(name, n)
+
+    def summary(self):
+        with self.lock:
+            lines = ["%-18s calls=%-8d wall=%.3fs cpu=%.3fs" % (name, calls, wall, cpu)
+                     for name, (calls, wall, cpu) in sorted(self.stages.items())]
+            lines += ["%s=%d" % item for item in sorted(self.counters.items())]
+        return "\n".join(lines)
+
+    def prometheus(self):
+        with self.lock:
+            stages = sorted((name, list(totals)) for name, totals in self.stages.items())
+            counters = sorted(self.counters.items())
+        lines = []
+        for metric, column, help_text in (("stage_calls_total", 0, "Calls of each stage"),
+                                          ("stage_seconds_total", 1, "Wall time spent in each stage"),
+                                          ("stage_cpu_seconds_total", 2, "CPU time spent in each stage")):
+            lines += ["# HELP avhrr_parser_%s %s" % (metric, help_text), "# TYPE avhrr_parser_%s counter" % metric]
+            lines += ['avhrr_parser_%s{stage="%s"} %s' % (metric, name, totals[column]) for name, totals in stages]
+        lines += ["# HELP avhrr_parser_products_total Products by outcome", "# TYPE avhrr_parser_products_total counter"]
+        lines += ['avhrr_parser_products_total{outcome="%s"} %d' % (name[9:], n)
+                  for name, n in counters if name.startswith("products_")]
+        for name, n in counters:
+            if not name.startswith("products_"):
+                lines += ["# TYPE avhrr_parser_%s_total counter" % name, "avhrr_parser_%s_total %d" % (name, n)]
+        lines += ["# TYPE avhrr_parser_last_run_timestamp_seconds gauge",
+                  "avhrr_parser_last_run_timestamp_seconds %d" % time.time()]
+        return "\n".join(lines) + "\n"
+
+    def write_prometheus(self, path):
+        # written aside and renamed, so the textfile collector never reads half a file
+        tmp_path = path + ".tmp"
+        with open(tmp_path, "w") as f:
+            f.write(self.prometheus())
+        os.replace(tmp_path, path)
+
+
+metrics = RunMetrics()
+
+
+def timed_stage(name):
+    '''Decorator adding the calls of a function to the metrics of a stage.'''
+    def decorator(function):
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            with metrics.stage(name):
+                return function(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def setup_logging(TMPDIR):
+    '''Log to avhrr_parser.log through a queue, so the file is written by a listener
+    thread instead of the processing code. Returns the listener and the file handler.'''
+    handler = logging.FileHandler(os.path.join(TMPDIR,'avhrr_parser.log'))
+    handler.setFormatter(logging.Formatter('INFO: %(asctime)s %(message)s', datefmt='%m/%d/%Y %I:%M:%S %p'))
+    log_queue = queue.SimpleQueue()
+    root = logging.getLogger()
+    root.setLevel(logging.INFO)
+    root.addHandler(logging.handlers.QueueHandler(log_queue))
+    listener = logging.handlers.QueueListener(log_queue, handler)
+    listener.start()
+    return listener, handler
 
 
 def setup_cmd_args():
@@ -15,55 +170,436 @@ def setup_cmd_args():
     parser = argparse.ArgumentParser(description="AVHRR metadata parser for nrtservice to be used for extracting metadata for the AVHRR products.", formatter_class=argparse.ArgumentDefaultsHelpFormatter)
     # parser.add_argument("src_dir", help="The root directory containing data to check")
     parser.add_argument("--noaa_mtd", help="The zipped NOAA sats metadata file remote location", default = "ftp://eogrid.esrin.esa.int/Catalogue/Noaa_catalogue_1_1.tgz")
+    parser.add_argument("--catalogue_check_interval", type=float, default=3600, help="Seconds during which the catalogue index is used without checking the NOAA sats metadata source for changes, 0 checks at every run")
     parser.add_argument("--output", help="Output folder for required metadata files")
     parser.add_argument("--avhrr_list", help="The list of files to process")
     parser.add_argument("--avhrr_file", help="The avhrr file path to process")
+    parser.add_argument("--scan", help="Root folder to scan for avhrr products to process")
     parser.add_argument("--ds", help="The dataset name for the avhrr file")
     parser.add_argument("-O", action='store_true', help="Organize the output folders of the avhrr file")
     parser.add_argument("-f", action='store_true', help="Separate the products without footprint")
     parser.add_argument("-r", action='store_true', help="Remove avhrr dir after zipping")
     parser.add_argument("-d", action='store_true', help="Read directly from metadata file, instead of csv files.")
     parser.add_argument("-l", action='store_true', help="Export csv list of processed/non-processed products")
+    parser.add_argument("--header_bytes", type=int, default=header_bytes, help="Maximum bytes read per product from the level files headers")
+    parser.add_argument("--tgz_index", nargs="?", const="", metavar="DIR", help="Cache the member table and gzip seek points of every .tgz product in DIR (default: OUTPUT/tgz_index), for products read again by later runs")
+    parser.add_argument("--compress_level", type=int, default=9, choices=range(0, 10), metavar="[0-9]", help="gzip level of the -O .tgz outputs")
+    parser.add_argument("--compress_threads", type=int, default=1, help="Threads compressing each -O .tgz output")
+    parser.add_argument("--tar", action='store_true', help="Write -O outputs of avhrr dirs as plain .tar instead of .tgz")
+    parser.add_argument("--transfer", default="auto", choices=transfer_methods, help="How -O stores .zip/.tgz inputs: auto picks the cheapest that works, with copy as the fallback")
+    parser.add_argument("--checksum", choices=checksum_algorithms, help="Digest the -O outputs as they are written, into the records csv and a MANIFEST.<checksum> per day folder")
+    parser.add_argument("--output_index", nargs="?", const="", metavar="INDEX", help="Keep an index of the -O output tree for the existence checks and --inventory, at INDEX (default: OUTPUT/avhrr_output_index.sqlite), built from disk on first use")
+    parser.add_argument("--rebuild_output_index", action='store_true', help="Rebuild the output tree index from disk, implies --output_index")
+    parser.add_argument("--inventory", metavar="PREFIX", help="List the indexed outputs under DATASET[/YYYY[/MM[/DD]]] ('' for all) as csv, implies --output_index")
+    parser.add_argument("--format", default="kv", choices=output_formats, help="Format of the printed metadata")
+    parser.add_argument("--batch", action='store_true', help="Write the metadata to one batch file per dataset in the output folder instead of stdout")
+    parser.add_argument("--flush_interval", type=float, default=5.0, help="Seconds between flushes of the metadata and records outputs, 0 flushes every product")
+    parser.add_argument("--resume", action='store_true', help="Skip the products the journal of earlier runs records as done, retry failed and interrupted ones")
+    parser.add_argument("--serve", action='store_true', help="Run as a server answering product requests from avhrr_client.py or HTTP")
+    parser.add_argument("--socket", help="Unix socket of the server (default: OUTPUT/avhrr_parser.sock)")
+    parser.add_argument("--http_port", type=int, help="Also serve GET /metadata?avhrr_file=PATH on this localhost port")
+    parser.add_argument("--serve_threads", type=int, default=4, help="Threads answering the requests of the server")
+    parser.add_argument("--refresh_interval", type=float, default=3600, help="Seconds between catalogue refresh checks of the server")
+    parser.add_argument("--bbox", type=query_bbox, help="Query the catalogue for the passes intersecting W,S,E,N (degrees)")
+    parser.add_argument("--polygon", type=query_polygon, help="Query the catalogue for the passes intersecting POLYGON((lon lat,...))")
+    parser.add_argument("--start", type=query_time, help="Query the catalogue for the passes ending after YYYY-MM-DD[THH:MM:SS]")
+    parser.add_argument("--stop", type=query_time, help="Query the catalogue for the passes starting before YYYY-MM-DD[THH:MM:SS]")
+    parser.add_argument("--metrics", help="Write the run metrics to this file in Prometheus textfile format")
+    parser.add_argument("--prefetch", type=int, default=0, help="Threads reading the next products (stat, catalogue, size, level headers) while the current one is processed, without --jobs")
+    parser.add_argument("--batch_join", action='store_true', help="Join the --avhrr_list/--scan products with the catalogue once for the batch, by sorting both, instead of using the catalogue index")
+    parser.add_argument("--join_run_size", type=int, default=1000000, help="Product ids or catalogue rows sorted in memory at a time by --batch_join, the rest goes through temporary files")
+    parser.add_argument("--jobs", type=int, default=1, help="Number of worker processes for the --avhrr_list/--scan products")
     return parser.parse_args()
 
 
-def prepare_datafiles(NOAA_sat_mtd, TMPDIR):
-    NOAA_sat_mtd_dir=os.path.join(TMPDIR,"NOAA_sat_mtd")
-    NOAA_sat_mtd_zip=os.path.join(TMPDIR,os.path.basename(NOAA_sat_mtd))
+class HashingWriter:
+    """File-like wrapper that digests the bytes written through it, so outputs
+    get their checksum without being read back."""
+
+    def __init__(self, fileobj, digest):
+        self.fileobj = fileobj
+        self.digest = digest
+        self.written = 0
+
+    def write(self, data):
+        self.digest.update(data)
+        self.written += len(data)
+        return self.fileobj.write(data)
+
+    def tell(self):
+        # tarfile asks where it starts, the output file starts empty
+        return self.written
+
+    def flush(self):
+        self.fileobj.flush()
+
+
+def local_source_path(NOAA_sat_mtd):
+    parsed = urllib.parse.urlparse(NOAA_sat_mtd)
+    if parsed.scheme == "file":
+        return urllib.request.url2pathname(parsed.path)
+    if parsed.scheme == "" or os.path.exists(NOAA_sat_mtd):
+        return NOAA_sat_mtd
+    return None
+
+
+def digest_file(path, digest):
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(1 << 20), b""):
+            digest.update(block)
+    return digest
+
+
+def file_checksum(path, algorithm="sha256"):
+    return digest_file(path, hashlib.new(algorithm)).hexdigest()
 
-    curl_string="curl \""+NOAA_sat_mtd+"\" -o \""+NOAA_sat_mtd_zip+"\""
+
+def ftp_source_state(NOAA_sat_mtd):
+    parsed = urllib.parse.urlparse(NOAA_sat_mtd)
+    state = {}
     try:
-        readout1 = subprocess.Popen(curl_string, shell=True, stdout=subprocess.PIPE, stderr=subprocess.PIPE, bufsize=1).communicate()[0]
-    except:
-        print("Some problem occurred while downloading the file")
-    shutil.rmtree(NOAA_sat_mtd_dir, ignore_errors=True)
-    os.mkdir(NOAA_sat_mtd_dir)
+        ftp = ftplib.FTP(parsed.hostname, timeout=60)
+        ftp.login(urllib.parse.unquote(parsed.username or "anonymous"), urllib.parse.unquote(parsed.password or ""))
+        ftp.voidcmd("TYPE I")
+        state["size"] = ftp.size(parsed.path)
+        state["mtime"] = ftp.voidcmd("MDTM " + parsed.path).split()[-1]
+        ftp.quit()
+    except (ftplib.all_errors + (ValueError,)):
+        state = {}
+    return state
+
+
+def open_catalogue_source(NOAA_sat_mtd, previous_state):
+    '''Open the catalogue tgz for streaming. Returns (stream, state), with stream
+    None when the source is unchanged since previous_state was recorded.'''
+    local_path = local_source_path(NOAA_sat_mtd)
+    if local_path != None:
+        st = os.stat(local_path)
+        state = {"size": st.st_size, "mtime": st.st_mtime_ns}
+        if previous_state.get("size") == state["size"] and previous_state.get("mtime") == state["mtime"]:
+            return None, previous_state
+        state["sha256"] = file_checksum(local_path)
+        if previous_state.get("sha256") == state["sha256"]:
+            return None, state
+        return open(local_path, "rb"), state
+    if urllib.parse.urlparse(NOAA_sat_mtd).scheme == "ftp":
+        state = ftp_source_state(NOAA_sat_mtd)
+        if state and state == previous_state:
+            return None, previous_state
+        response = urllib.request.urlopen(NOAA_sat_mtd, timeout=60)
+        if not state: state = {"size": response.headers.get("Content-Length")}
+        return response, state
+    request = urllib.request.Request(NOAA_sat_mtd)
+    if previous_state.get("etag"): request.add_header("If-None-Match", previous_state["etag"])
+    if previous_state.get("last_modified"): request.add_header("If-Modified-Since", previous_state["last_modified"])
     try:
-        tar_string="tar -xvzf "+NOAA_sat_mtd_zip+" -C "+NOAA_sat_mtd_dir
-        readout2 = subprocess.Popen(tar_string, shell=True, stdout=subprocess.PIPE, stderr=subprocess.PIPE, bufsize=1).communicate()[0]
-    except:
-        print("Some problem occurred while unzipping the file")
-    return NOAA_sat_mtd_dir
+        response = urllib.request.urlopen(request, timeout=60)
+    except urllib.error.HTTPError as e:
+        if e.code == 304:
+            return None, previous_state
+        raise
+    state = {"etag": response.headers.get("ETag"), "last_modified": response.headers.get("Last-Modified"),
+             "size": response.headers.get("Content-Length")}
+    if (state["etag"] or state["last_modified"]) and state == previous_state:
+        response.close()
+        return None, previous_state
+    return response, state
+
+
+def stream_catalogue_index(stream, index_path, NOAA_sat_mtd, state):
+    '''Parse the CSV members of the catalogue tgz straight from the stream into a
+    fresh index, then swap it in place of the previous one.'''
+    with building_index(index_path) as conn:
+        with tarfile.open(fileobj=stream, mode="r|gz") as tar:
+            for member in tar:
+                if member.isfile() and member.name.lower().endswith(".csv"):
+                    # stream members are not seekable, which a text wrapper insists on
+                    csvfile = codecs.iterdecode(tar.extractfile(member), "utf8", "ignore")
+                    metrics.count("catalogue_bytes_scanned", member.size)
+                    index_csv_rows(conn, csv.reader(csvfile), os.path.basename(member.name))
+        conn.execute("INSERT OR REPLACE INTO meta VALUES ('source', ?)", (NOAA_sat_mtd,))
+        conn.execute("INSERT OR REPLACE INTO meta VALUES ('source_state', ?)", (json.dumps(state, sort_keys=True),))
+
+
+def set_index_meta(index_path, key, value):
+    conn = sqlite3.connect(index_path)
+    conn.execute("INSERT OR REPLACE INTO meta VALUES (?, ?)", (key, value))
+    conn.commit()
+    conn.close()
+
 
+@timed_stage("catalogue_refresh")
+def prepare_datafiles(NOAA_sat_mtd, TMPDIR, check_interval=0):
+    '''Refresh the catalogue index from the NOAA sats metadata source, skipping
+    the download when the source did not change, and return a connection to it.
+    The source is not contacted at all when it was checked less than
+    check_interval seconds ago.'''
+    index_path = catalogue_index_path(TMPDIR)
+    # the others wait and then find the index refreshed, or checked just now
+    with catalogue_lock(index_path):
+        local_path = local_source_path(NOAA_sat_mtd)
+        if local_path != None and os.path.isdir(local_path):
+            csv_files = [os.path.join(local_path, f) for f in os.listdir(local_path)]
+            return open_catalogue_index(csv_files, index_path)
+        previous_state = {}
+        if get_index_meta(index_path, 'source') == NOAA_sat_mtd:
+            checked = float(get_index_meta(index_path, 'checked') or 0)
+            if time.time() - checked < check_interval:
+                logging.info("NOAA sats metadata was checked less than " + str(check_interval) + "s ago")
+                return sqlite3.connect(index_path)
+            previous_state = json.loads(get_index_meta(index_path, 'source_state') or "{}")
+        try:
+            stream, state = open_catalogue_source(NOAA_sat_mtd, previous_state)
+            if stream == None:
+                logging.info("NOAA sats metadata is up to date")
+                if state != previous_state:
+                    set_index_meta(index_path, 'source_state', json.dumps(state, sort_keys=True))
+            else:
+                logging.info("Refreshing NOAA sats metadata from " + NOAA_sat_mtd)
+                with stream:
+                    stream_catalogue_index(stream, index_path, NOAA_sat_mtd, state)
+            set_index_meta(index_path, 'checked', str(time.time()))
+        except (OSError, tarfile.TarError, sqlite3.Error) as e:
+            # stdout carries the metadata
+            print("Some problem occurred while refreshing the NOAA sats metadata", file=sys.stderr)
+            logging.info("Could not refresh the NOAA sats metadata: " + str(e))
+            if not os.path.exists(index_path):
+                # fall back to a catalogue extracted by earlier versions of the parser
+                NOAA_sat_mtd_dir = os.path.join(TMPDIR, "NOAA_sat_mtd")
+                csv_files = []
+                if os.path.isdir(NOAA_sat_mtd_dir):
+                    csv_files = [os.path.join(NOAA_sat_mtd_dir, f) for f in os.listdir(NOAA_sat_mtd_dir)]
+                return open_catalogue_index(csv_files, index_path)
+        return sqlite3.connect(index_path)
+
+
+def catalogue_fingerprint(csv_files):
+    """Digest of the name, size and mtime of every catalogue CSV, used to detect a changed CSV set."""
+    h = hashlib.sha1()
+    for f in sorted(csv_files):
+        st = os.stat(f)
+        h.update(("%s|%d|%d\n" % (os.path.basename(f), st.st_size, st.st_mtime_ns)).encode())
+    return h.hexdigest()
+
+
+def create_catalogue_schema(conn):
+    conn.execute("CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT)")
+    conn.execute("CREATE TABLE IF NOT EXISTS catalogue (product_id TEXT PRIMARY KEY, source TEXT, row TEXT)")
+
+
+def index_csv_rows(conn, rows, source):
+    # Rows are keyed on their exact first column, the product id the catalogue
+    # CSVs start every pass with and input_product_id takes from the file name.
+    # The old scan matched the id as a substring of any cell, which could also
+    # pick the row of a longer id containing it or a cell of another column;
+    # every product it found right has its id in column 0.
+    # The catalogue scan kept the last matching line, INSERT OR REPLACE does the same
+    conn.executemany("INSERT OR REPLACE INTO catalogue VALUES (?, ?, ?)",
+                     ((data[0].strip(), source, json.dumps(data)) for data in rows if data and data[0].strip()))
+
+
+def build_catalogue_index(csv_files, index_path):
+    with building_index(index_path) as conn:
+        for f in sorted(csv_files):
+            metrics.count("catalogue_bytes_scanned", os.path.getsize(f))
+            with open(f, newline='', encoding="utf8", errors='ignore') as csvfile:
+                index_csv_rows(conn, csv.reader(csvfile), os.path.basename(f))
+        conn.execute("INSERT OR REPLACE INTO meta VALUES ('fingerprint', ?)", (catalogue_fingerprint(csv_files),))
+
+
+@contextlib.contextmanager
+def building_index(index_path):
+    '''Connection to a new catalogue index, built aside under a name of this
+    process and swapped in place of index_path once complete.'''
+    tmp_path = "%s.%d.tmp" % (index_path, os.getpid())
+    if os.path.exists(tmp_path):
+        os.remove(tmp_path)
+    conn = sqlite3.connect(tmp_path)
+    try:
+        create_catalogue_schema(conn)
+        yield conn
+        conn.commit()
+        conn.close()
+        os.replace(tmp_path, index_path)
+    except BaseException:
+        conn.close()
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+
+
+@contextlib.contextmanager
+def catalogue_lock(index_path):
+    '''Hold the lock of the catalogue index, so runs, servers and workers
+    sharing an output folder refresh it one at a time.'''
+    with open(index_path + ".lock", "a") as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(lock, fcntl.LOCK_UN)
+
+
+def get_index_meta(index_path, key):
+    value = None
+    if os.path.exists(index_path):
+        try:
+            conn = sqlite3.connect(index_path)
+            row = conn.execute("SELECT value FROM meta WHERE key = ?", (key,)).fetchone()
+            conn.close()
+            if row: value = row[0]
+        except sqlite3.Error:
+            value = None
+    return value
+
+
+def open_catalogue_index(csv_files, index_path):
+    '''Open the product id index of the catalogue CSVs, (re)building it first
+    when the CSV set changed since it was built.'''
+    if get_index_meta(index_path, 'fingerprint') != catalogue_fingerprint(csv_files):
+        logging.info("Building catalogue index " + index_path)
+        build_catalogue_index(csv_files, index_path)
+    return sqlite3.connect(index_path)
 
-def find_right_csv(string_to_find,csv_files):
-    right_csv=None
-    for f in csv_files:
-        if string_to_find in open(f).read():
-            right_csv=f
-    return right_csv
 
+def catalogue_rows(NOAA_sat_mtd):
+    '''(source, row) of every catalogue CSV row, read once straight from the
+    source folder or tgz, in the order the index takes them.'''
+    local_path = local_source_path(NOAA_sat_mtd)
+    if local_path != None and os.path.isdir(local_path):
+        for f in sorted(os.listdir(local_path)):
+            path = os.path.join(local_path, f)
+            metrics.count("catalogue_bytes_scanned", os.path.getsize(path))
+            with open(path, newline='', encoding="utf8", errors='ignore') as csvfile:
+                for data in csv.reader(csvfile):
+                    yield f, data
+        return
+    stream = open(local_path, "rb") if local_path != None else open_catalogue_source(NOAA_sat_mtd, {})[0]
+    with stream, tarfile.open(fileobj=stream, mode="r|gz") as tar:
+        for member in tar:
+            if member.isfile() and member.name.lower().endswith(".csv"):
+                metrics.count("catalogue_bytes_scanned", member.size)
+                for data in csv.reader(codecs.iterdecode(tar.extractfile(member), "utf8", "ignore")):
+                    yield os.path.basename(member.name), data
 
-def get_right_line(csvfile, srchstring):
-    right_line=None
-    reader = csv.reader(open(csvfile, 'r'))
-    for data in reader:
-        #list index start from 0, thus 2938 is in data[1]
-        if any(srchstring in s for s in data):
-            right_line=data
+
+def sorted_runs(lines, run_size, tmp_dir, name):
+    '''Write lines into files of at most run_size sorted lines, merged down to
+    at most merge_fan_in files. Returns their paths.'''
+    paths = []
+    chunk = []
+    for line in lines:
+        chunk.append(line)
+        if len(chunk) >= run_size:
+            paths.append(write_run(chunk, tmp_dir, name + "_" + str(len(paths))))
+            chunk = []
+    if chunk or not paths:
+        paths.append(write_run(chunk, tmp_dir, name + "_" + str(len(paths))))
+    generation = 0
+    while len(paths) > merge_fan_in:
+        generation += 1
+        merged = []
+        for i in range(0, len(paths), merge_fan_in):
+            path = os.path.join(tmp_dir, name + "_" + str(generation) + "_" + str(len(merged)))
+            with open(path, "w", encoding="utf8") as f:
+                f.writelines(line + "\n" for line in merge_runs(paths[i:i + merge_fan_in]))
+            for run in paths[i:i + merge_fan_in]:
+                os.remove(run)
+            merged.append(path)
+        paths = merged
+    return paths
+
+
+def write_run(chunk, tmp_dir, name):
+    path = os.path.join(tmp_dir, name)
+    chunk.sort()
+    with open(path, "w", encoding="utf8") as f:
+        f.writelines(line + "\n" for line in chunk)
+    return path
+
+
+def merge_runs(paths):
+    '''The lines of the sorted run files, merged in order without the newlines.'''
+    with contextlib.ExitStack() as stack:
+        runs = [stack.enter_context(open(path, encoding="utf8")) for path in paths]
+        for line in heapq.merge(*runs):
+            yield line[:-1]
+
+
+def merge_join(ids, rows):
+    '''(product_id, source, row) for the ids found in the rows, both sorted by
+    product id. Like the index, the last row of a product id wins.'''
+    current = next(ids, None)
+    pending = None
+    for line in rows:
+        productid, seq, source, row = line.split("\t", 3)
+        if pending != None and pending[0] != productid:
+            yield pending
+            pending = None
+        while current != None and current < productid:
+            current = next(ids, None)
+        if current == None:
+            break
+        if current == productid:
+            pending = (productid, source, row)
+    if pending != None:
+        yield pending
+
+
+@timed_stage("batch_join")
+def batch_join_catalogue(NOAA_sat_mtd, inputs, join_dir, run_size):
+    '''Join the inputs with the catalogue once per batch, without the catalogue
+    index: sort the product ids, stream every catalogue CSV once, sort its rows
+    by product id and merge the two. At most run_size ids or rows are held in
+    memory, the rest goes through sorted run files in join_dir. Returns the
+    inputs, replayed from a spool file, and the path of a table of the joined
+    rows with the catalogue index schema, for lookup_product.'''
+    spool_path = os.path.join(join_dir, "inputs.jsonl")
+    with open(spool_path, "w", encoding="utf8") as spool:
+        def product_ids():
+            for line, img in inputs:
+                spool.write(json.dumps([line, img]) + "\n")
+                if img != '':
+                    yield input_product_id(img)
+        id_runs = sorted_runs(product_ids(), run_size, join_dir, "ids")
+    wanted = None
+    if len(id_runs) == 1:
+        # the ids fit in memory, the rows of other products need not be sorted
+        wanted = set(merge_runs(id_runs))
+
+    def keyed_rows():
+        for seq, (source, data) in enumerate(catalogue_rows(NOAA_sat_mtd)):
+            productid = data[0].strip() if data else ''
+            if productid and (wanted == None or productid in wanted):
+                yield productid + "\t" + "%012d" % seq + "\t" + source + "\t" + json.dumps(data)
+    row_runs = sorted_runs(keyed_rows(), run_size, join_dir, "rows")
+    index_path = os.path.join(join_dir, "catalogue.sqlite")
+    conn = sqlite3.connect(index_path)
+    create_catalogue_schema(conn)
+    conn.executemany("INSERT OR REPLACE INTO catalogue VALUES (?, ?, ?)", merge_join(merge_runs(id_runs), merge_runs(row_runs)))
+    conn.commit()
+    logging.info("Joined " + str(conn.execute("SELECT COUNT(*) FROM catalogue").fetchone()[0]) + " products with the catalogue")
+    conn.close()
+    for path in id_runs + row_runs:
+        os.remove(path)
+
+    def replay():
+        with open(spool_path, encoding="utf8") as spool:
+            for line in spool:
+                yield tuple(json.loads(line))
+    return replay(), index_path
+
+
+@timed_stage("catalogue_lookup")
+def lookup_product(catalogue, productid):
+    right_line = None
+    row = catalogue.execute("SELECT row FROM catalogue WHERE product_id = ?", (productid,)).fetchone()
+    if row:
+        right_line = json.loads(row[0])
     return right_line
 
 
+@timed_stage("size_walk")
 def get_size(path):
     total_size = 0
     ext = os.path.splitext(path)[-1]
@@ -96,6 +632,203 @@ def parse_footprint(corners):
     return footprint, okfootprint
 
 
+def corner_points(corners):
+    '''The (lon, lat) corners of a catalogue footprint, None for the passes
+    parse_footprint has no footprint for.'''
+    try:
+        values = [float(i) for i in corners.split()]
+    except ValueError:
+        return None
+    if len(values) < 8:
+        return None
+    return [(values[1], values[0]), (values[3], values[2]), (values[5], values[4]), (values[7], values[6])]
+
+
+def clock_seconds(hhmmss):
+    if len(hhmmss) != 6:
+        raise ValueError("bad time " + hhmmss)
+    t = datetime.time(int(hhmmss[0:2]), int(hhmmss[2:4]), int(hhmmss[4:6]))
+    return t.hour * 3600 + t.minute * 60 + t.second
+
+
+def pass_seconds(theline):
+    '''Start and stop of a pass in seconds since 1970, the stop of passes over
+    midnight falls on the next day. Same dates as parse_time, without strptime
+    which is most of the cost of indexing millions of passes.'''
+    date = theline[1]
+    if len(date) != 6:
+        raise ValueError("bad date " + date)
+    year = int(date[0:2])
+    year += 1900 if year >= 69 else 2000
+    day = (datetime.date(year, int(date[2:4]), int(date[4:6])) - epoch.date()).days * 86400
+    start, stop = day + clock_seconds(theline[2]), day + clock_seconds(theline[3])
+    if stop < start:
+        stop += 86400
+    return start, stop
+
+
+def unwrap_points(points):
+    '''Footprints across the antimeridian with their western longitudes moved
+    east of 180, so their edges do not go round the world.'''
+    if max(p[0] for p in points) - min(p[0] for p in points) > 180:
+        return [(lon + 360 if lon < 0 else lon, lat) for lon, lat in points]
+    return points
+
+
+def query_time(value):
+    '''--start/--stop value as seconds since 1970.'''
+    for fmt in '%Y-%m-%dT%H:%M:%S.000Z', '%Y-%m-%dT%H:%M:%S', '%Y-%m-%d':
+        try:
+            return (datetime.datetime.strptime(value, fmt) - epoch).total_seconds()
+        except ValueError:
+            pass
+    raise ValueError("expected YYYY-MM-DD[THH:MM:SS]: " + value)
+
+
+def query_bbox(value):
+    '''--bbox W,S,E,N as query polygons, two of them when it crosses the antimeridian.'''
+    west, south, east, north = [float(i) for i in value.split(",")]
+    if west > east:
+        return query_bbox("%s,%s,180,%s" % (west, south, north)) + query_bbox("-180,%s,%s,%s" % (south, east, north))
+    return [[(west, south), (east, south), (east, north), (west, north)]]
+
+
+def query_polygon(value):
+    '''--polygon in the WKT of the footprint outputs, POLYGON((lon lat,...)).'''
+    match = re.match(r'\s*POLYGON\s*\(\((.*)\)\)\s*$', value, re.IGNORECASE)
+    if not match:
+        raise ValueError("expected POLYGON((lon lat,...)): " + value)
+    return [[tuple(float(i) for i in point.split()) for point in match.group(1).split(",")]]
+
+
+def orientation(a, b, c):
+    return (b[0] - a[0]) * (c[1] - a[1]) - (b[1] - a[1]) * (c[0] - a[0])
+
+
+def segments_cross(p1, p2, q1, q2):
+    d1, d2 = orientation(q1, q2, p1), orientation(q1, q2, p2)
+    d3, d4 = orientation(p1, p2, q1), orientation(p1, p2, q2)
+    if d1 == d2 == d3 == d4 == 0:
+        # collinear, they cross when their extents overlap
+        return all(max(min(p1[i], p2[i]), min(q1[i], q2[i])) <= min(max(p1[i], p2[i]), max(q1[i], q2[i])) for i in (0, 1))
+    return min(d1, d2) <= 0 <= max(d1, d2) and min(d3, d4) <= 0 <= max(d3, d4)
+
+
+def point_in_polygon(point, polygon):
+    inside = False
+    x, y = point
+    for (x1, y1), (x2, y2) in zip(polygon, polygon[1:] + polygon[:1]):
+        if (y1 > y) != (y2 > y) and x < x1 + (y - y1) * (x2 - x1) / (y2 - y1):
+            inside = not inside
+    return inside
+
+
+def polygons_intersect(a, b):
+    for p1, p2 in zip(a, a[1:] + a[:1]):
+        for q1, q2 in zip(b, b[1:] + b[:1]):
+            if segments_cross(p1, p2, q1, q2):
+                return True
+    return point_in_polygon(a[0], b) or point_in_polygon(b[0], a)
+
+
+@timed_stage("footprint_index")
+def build_footprint_index(catalogue):
+    '''Parse the corners and times of every catalogue pass once into an R*Tree
+    of bounding boxes and time spans next to the catalogue table. Passes without
+    footprint get the whole world, like their NOFP footprint.'''
+    with catalogue:
+        catalogue.execute("DELETE FROM meta WHERE key = 'footprint_index'")
+        catalogue.execute("DROP TABLE IF EXISTS footprint_tree")
+        catalogue.execute("CREATE VIRTUAL TABLE footprint_tree USING rtree(id, min_lon, max_lon, min_lat, max_lat, start, stop, "
+                          "+product_id TEXT, +corners TEXT, +start_s REAL, +stop_s REAL)")
+        entries = []
+        passes = 0
+        for product_id, row in catalogue.execute("SELECT product_id, row FROM catalogue"):
+            theline = json.loads(row)
+            try:
+                start, stop = pass_seconds(theline)
+            except (ValueError, IndexError):
+                continue
+            points = corner_points(theline[8])
+            boxes = [(-180, 180, -90, 90)]
+            corners = None
+            if points != None:
+                points = unwrap_points(points)
+                lons, lats = [p[0] for p in points], [p[1] for p in points]
+                boxes = [(min(lons), max(lons), min(lats), max(lats))]
+                if max(lons) > 180:
+                    # across the antimeridian, also indexed shifted west of -180
+                    boxes.append((min(lons) - 360, max(lons) - 360, min(lats), max(lats)))
+                corners = theline[8]
+            entries.extend(box + (start, stop, product_id, corners, start, stop) for box in boxes)
+            passes += 1
+            if len(entries) >= 10000:
+                catalogue.executemany("INSERT INTO footprint_tree VALUES (NULL, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)", entries)
+                entries = []
+        catalogue.executemany("INSERT INTO footprint_tree VALUES (NULL, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)", entries)
+        catalogue.execute("INSERT OR REPLACE INTO meta VALUES ('footprint_index', ?)", (str(passes),))
+
+
+@timed_stage("query")
+def query_catalogue(catalogue, area=None, start=None, stop=None):
+    '''Catalogue lines of the passes whose footprint intersects one of the area
+    polygons and whose time span overlaps start-stop (seconds since 1970), in
+    time order. Passes without footprint match any area, query_fields flags them.'''
+    if catalogue.execute("SELECT 1 FROM meta WHERE key = 'footprint_index'").fetchone() == None:
+        build_footprint_index(catalogue)
+    conditions = []
+    params = []
+    if start != None:
+        conditions.append("stop >= ?")
+        params.append(start)
+    if stop != None:
+        conditions.append("start <= ?")
+        params.append(stop)
+    found = {}
+    for polygon in area or [None]:
+        polygon_conditions = list(conditions)
+        polygon_params = list(params)
+        if polygon != None:
+            polygon_conditions += ["max_lon >= ?", "min_lon <= ?", "max_lat >= ?", "min_lat <= ?"]
+            polygon_params += [min(p[0] for p in polygon), max(p[0] for p in polygon),
+                               min(p[1] for p in polygon), max(p[1] for p in polygon)]
+        sql = "SELECT product_id, corners, start_s, stop_s FROM footprint_tree"
+        if polygon_conditions:
+            sql += " WHERE " + " AND ".join(polygon_conditions)
+        for product_id, corners, start_s, stop_s in catalogue.execute(sql, polygon_params):
+            # the tree keeps 32 bit floats rounded outwards, the exact checks are done here
+            if product_id in found or (start != None and stop_s < start) or (stop != None and start_s > stop):
+                continue
+            if polygon != None and corners != None:
+                points = unwrap_points(corner_points(corners))
+                if not (polygons_intersect(points, polygon) or (max(p[0] for p in points) > 180
+                        and polygons_intersect([(p[0] - 360, p[1]) for p in points], polygon))):
+                    continue
+            found[product_id] = start_s
+    lines = []
+    for product_id in sorted(found, key=found.get):
+        row = catalogue.execute("SELECT row FROM catalogue WHERE product_id = ?", (product_id,)).fetchone()
+        lines.append(json.loads(row[0]))
+    return lines
+
+
+def query_fields(theline, ds=None):
+    '''Metadata fields of a catalogue pass returned by a query, there is no
+    product to measure so size is empty. Passes without footprint always get
+    a _NOFP dataset, --ds with _NOFP appended when given.'''
+    footprint, footprint_ok = parse_footprint(theline[8])
+    level = normalize_level(theline[7]) if theline[7] != '' else 'Not available'
+    dataset = get_dataset(ds, level, footprint_ok)
+    if ds != None and not footprint_ok:
+        # their whole-world footprint would otherwise pass for a real one
+        dataset += "_NOFP"
+    return {"product": theline[0], "dataset": dataset,
+            "acquisition_station": re.sub(' +', '_', theline[5]),
+            "start_orbit_number": theline[6].replace("*****", "0").replace("?????", "0"), "size": '',
+            "start_time": parse_time(theline[1], theline[2])[0], "stop_time": parse_time(theline[1], theline[3])[0],
+            "footprint": footprint}
+
+
 def get_dataset(ds, level, footprint):
     if ds == None:
         if footprint:
@@ -116,111 +849,461 @@ def locate(file, root):
     return avhrr_file_path
 
 
-def compose_output(img, img_path, theline, ds, footprint):
+class ProductRecord:
+    """Metadata of one product, gathered by inspect_product in a single pass."""
+    __slots__ = ("product", "path", "archive", "level", "dataset", "footprint", "footprint_ok", "size",
+                 "start_time", "stop_time", "start_date", "orbit", "station")
+
+    def __init__(self, **fields):
+        for name in self.__slots__:
+            setattr(self, name, fields.get(name))
+
+
+@timed_stage("inspect")
+def inspect_product(productid, img_path, theline, ds, separate_nofp, max_bytes=header_bytes, index_dir=None):
+    '''Open the product directory or archive once and gather everything the
+    outputs need. With theline None the metadata comes from the product .ief file.'''
     ext = os.path.splitext(img_path)[-1]
-    if ext in zipped:
-        plevel = get_level_in_zipped(img_path, theline)
+    archive = ext in zipped
+    if archive:
+        size = os.path.getsize(img_path)
+        with open_archive(img_path, index_dir) as opened:
+            if theline == None:
+                theline = parse_ief(productid, read_archive_ief(opened, productid))
+            level = get_level_in_zipped(opened, theline, max_bytes, productid)
     else:
-        plevel = get_level(os.path.join(img_path, img), theline)
-    ds = get_dataset(ds, plevel, footprint)
+        size = get_size(img_path)
+        if theline == None:
+            with open(os.path.join(img_path, productid + ".ief"), "r") as m:
+                theline = parse_ief(productid, str(m.read()))
+        level = get_level(img_path, theline, max_bytes)
+    footprint, footprint_ok = parse_footprint(theline[8])
+    start_time, start_date = parse_time(theline[1], theline[2])
+    return ProductRecord(product=productid, path=img_path, archive=archive, level=level,
+                         dataset=get_dataset(ds, level, footprint_ok or not separate_nofp),
+                         footprint=footprint, footprint_ok=footprint_ok, size=size,
+                         start_time=start_time, stop_time=parse_time(theline[1], theline[3])[0], start_date=start_date,
+                         orbit=theline[6].replace("*****", "0").replace("?????", "0"), station=theline[5])
+
+
+def product_fields(record):
+    return {"product": record.product, "dataset": record.dataset,
+            "acquisition_station": re.sub(' +', '_', record.station), "start_orbit_number": record.orbit,
+            "size": record.size, "start_time": record.start_time, "stop_time": record.stop_time,
+            "footprint": record.footprint}
+
+
+def format_kv(fields):
     acq_station = ''
-    if theline[5] != '': acq_station = "acquisition_station=" + theline[5]
-    finalstrg = "product=" + img + "\n" \
-                "dataset=" + ds + "\n" \
-                + re.sub(' +', '_', acq_station) + "\n" \
-                "start_orbit_number=" + theline[6].replace("?????","0") + "\n" \
-                "size=" + str(get_size(img_path)) + "\n" \
-                "start_time=" + str(parse_time(theline[1], theline[2])[0]) + "\n" \
-                "stop_time=" + str(parse_time(theline[1], theline[3])[0]) + "\n" \
-                "footprint='" + parse_footprint(theline[8])[0] + "'"
+    if fields["acquisition_station"] != '': acq_station = "acquisition_station=" + fields["acquisition_station"]
+    finalstrg = "product=" + fields["product"] + "\n" \
+                "dataset=" + fields["dataset"] + "\n" \
+                + acq_station + "\n" \
+                "start_orbit_number=" + fields["start_orbit_number"] + "\n" \
+                "size=" + str(fields["size"]) + "\n" \
+                "start_time=" + fields["start_time"] + "\n" \
+                "stop_time=" + fields["stop_time"] + "\n" \
+                "footprint='" + fields["footprint"] + "'"
     return finalstrg
 
 
-def folder_structure(outdir, level, date, ds, footprint):
-    ds = get_dataset(ds, level, footprint)
-    mkpath = outdir
-    month = "{0:0=2d}".format(date.month)
-    day = "{0:0=2d}".format(date.day)
-    for dir in ds, date.year, month, day:
-        dir = os.path.join(mkpath,str(dir))
-        if not os.path.exists(dir):
-            os.mkdir(dir)
-        mkpath = os.path.join(mkpath, dir)
-    return mkpath
+def normalize_level(level):
+    if not level[1:] == "L":
+        level = "L"+level
+    return level
+
+
+def search_level(header):
+    level = None
+    for p in level_patterns:
+        match = p.search(header)
+        if match:
+            level = match.group(0).decode("ascii")
+            break
+    return level
 
 
-def get_level(file, metadata):
+@timed_stage("level_headers")
+def level_file_folders(productid):
+    '''The folders of a product the level files may sit in, relative to its root:
+    the root itself, a folder named after the product (the archives make_tarfile
+    writes) and, for .SHRK products, the folder of the id without .SHRK.'''
+    folders = ["", productid]
+    if productid.endswith(".SHRK"):
+        folders += [productid[:-5], productid + "/" + productid[:-5]]
+    return folders
+
+
+def get_level(file, metadata, max_bytes=header_bytes):
     level = metadata[7]
     if level == '':
-        for sf in searchfiles:
-            sf = os.path.join(file, sf)
-            if os.path.exists(sf):
-                # mtdtext = open(sf).read()
-                with open(sf, encoding="utf8", errors='ignore') as f:
-                    mtdtext = f.read()
-                for p in level_patterns:
-                    level = re.search(p, mtdtext)
+        level = None
+        budget = max_bytes
+        for folder in level_file_folders(os.path.basename(file)):
+            folder = os.path.join(file, folder)
+            for sf in searchfiles:
+                sf = os.path.join(folder, sf)
+                if budget > 0 and os.path.exists(sf):
+                    with open(sf, "rb") as f:
+                        header = f.read(budget)
+                    budget -= len(header)
+                    metrics.count("bytes_read", len(header))
+                    level = search_level(header)
                     if level:
-                        level = level.group(0)
                         break
-    elif not level[1:] == "L":
-        level = "L"+level
+            if level:
+                break
+    else:
+        level = normalize_level(level)
     if level == None: level = 'Not available'
     return level
 
 
-def get_level_in_zipped(ofile, metadata):
-    level = metadata[7]
+@timed_stage("archive_open")
+def open_archive(ofile, index_dir=None):
     ext = os.path.splitext(ofile)[-1]
+    metrics.count("archives_opened")
     if ext == ".zip":
-        archive = zipfile.ZipFile(ofile, 'r')
-        filelist = archive.namelist()
+        return zipfile.ZipFile(ofile, 'r')
+    if ext == ".tgz" and index_dir != None:
+        try:
+            return IndexedTgz(ofile, get_tgz_index(index_dir, ofile))
+        except (OSError, EOFError, zlib.error, tarfile.TarError, ValueError):
+            logging.info("Could not index " + ofile + ", reading it sequentially")
+    return tarfile.open(ofile, "r:*")
+
+
+def archive_names(archive):
+    if isinstance(archive, zipfile.ZipFile):
+        return archive.namelist()
+    return archive.getnames()
+
+
+def open_archive_member(archive, name):
+    if isinstance(archive, zipfile.ZipFile):
+        return archive.open(name)
+    return archive.extractfile(name)
+
+
+def read_archive_member(archive, name):
+    if isinstance(archive, zipfile.ZipFile):
+        data = archive.read(name)
     else:
-        tar = tarfile.open(ofile, "r:gz")
-        filelist = tar.getmembers()
+        with archive.extractfile(name) as f:
+            data = f.read()
+    metrics.count("bytes_read", len(data))
+    return data
+
+
+class GzipStreamReader:
+    """Sequential reader of a (multi-member) gzip stream that notes the compressed
+    and uncompressed offsets where every gzip member starts."""
+
+    def __init__(self, fileobj, offset=0, uoffset=0):
+        self.fileobj = fileobj
+        self.fed = offset
+        self.produced = uoffset
+        self.decompressor = zlib.decompressobj(31)
+        self.buffer = bytearray()
+        self.seek_points = [(offset, uoffset)]
+        self.exhausted = False
+
+    def _feed(self, data):
+        while data:
+            if self.decompressor.eof:
+                if not data.strip(b"\0"):
+                    # zero padding after the last member
+                    return
+                self.decompressor = zlib.decompressobj(31)
+                self.seek_points.append((self.fed - len(data), self.produced))
+            out = self.decompressor.decompress(data)
+            self.produced += len(out)
+            self.buffer += out
+            data = self.decompressor.unused_data if self.decompressor.eof else b""
+
+    def read(self, size=-1):
+        while (size < 0 or len(self.buffer) < size) and not self.exhausted:
+            chunk = self.fileobj.read(1 << 16)
+            if not chunk:
+                self.exhausted = True
+                break
+            self.fed += len(chunk)
+            self._feed(chunk)
+        if size < 0:
+            size = len(self.buffer)
+        data = bytes(self.buffer[:size])
+        del self.buffer[:size]
+        return data
+
+    def skip(self, size):
+        while size > 0:
+            data = self.read(min(size, 1 << 20))
+            if not data:
+                break
+            size -= len(data)
+
+
+def tgz_index_file(index_dir, ofile):
+    return os.path.join(index_dir, hashlib.sha1(os.path.abspath(ofile).encode()).hexdigest() + ".json")
+
+
+def build_tgz_index(ofile):
+    '''Scan the archive once and record its member table and gzip seek points.'''
+    st = os.stat(ofile)
+    members = []
+    with open(ofile, "rb") as f:
+        reader = GzipStreamReader(f)
+        with tarfile.open(fileobj=reader, mode="r|") as tar:
+            for member in tar:
+                if member.isfile():
+                    members.append((member.name, member.offset_data, member.size))
+        reader.read()
+    return {"path": os.path.abspath(ofile), "size": st.st_size, "mtime": st.st_mtime_ns,
+            "members": members, "seek_points": reader.seek_points}
+
+
+@timed_stage("tgz_index")
+def get_tgz_index(index_dir, ofile):
+    '''Return the cached index of a .tgz, rebuilding it when the archive size or mtime changed.'''
+    index_file = tgz_index_file(index_dir, ofile)
+    st = os.stat(ofile)
+    try:
+        with open(index_file) as f:
+            index = json.load(f)
+        if index["size"] == st.st_size and index["mtime"] == st.st_mtime_ns:
+            return index
+    except (OSError, ValueError, KeyError):
+        pass
+    index = build_tgz_index(ofile)
+    os.makedirs(index_dir, exist_ok=True)
+    tmp_file = "%s.%d.tmp" % (index_file, os.getpid())
+    with open(tmp_file, "w") as f:
+        json.dump(index, f)
+    os.replace(tmp_file, index_file)
+    return index
+
+
+class TgzMemberReader:
+    """Reads one member of an indexed .tgz, starting from the closest gzip seek point."""
+
+    def __init__(self, ofile, seek_point, offset, size):
+        self.fileobj = open(ofile, "rb")
+        self.fileobj.seek(seek_point[0])
+        self.reader = GzipStreamReader(self.fileobj, seek_point[0], seek_point[1])
+        self.reader.skip(offset - seek_point[1])
+        self.remaining = size
+
+    def read(self, size=-1):
+        if size < 0 or size > self.remaining:
+            size = self.remaining
+        data = self.reader.read(size)
+        self.remaining -= len(data)
+        return data
+
+    def close(self):
+        self.fileobj.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+class IndexedTgz:
+    """Read-only view of a .tgz backed by its cached member index, with the
+    parts of the TarFile interface the parser uses."""
+
+    def __init__(self, ofile, index):
+        self.ofile = ofile
+        self.seek_points = index["seek_points"]
+        self.members = dict((name, (offset, size)) for name, offset, size in index["members"])
+
+    def getnames(self):
+        return list(self.members)
+
+    def extractfile(self, name):
+        offset, size = self.members[name]
+        seek_point = self.seek_points[0]
+        for point in self.seek_points:
+            if point[1] <= offset:
+                seek_point = point
+        return TgzMemberReader(self.ofile, seek_point, offset, size)
+
+    def close(self):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+@timed_stage("level_headers")
+def get_level_in_zipped(archive, metadata, max_bytes=header_bytes, productid=""):
+    level = metadata[7]
     if level == '':
-        for sf in searchfiles:
-            #sf = os.path.join(file, sf)
-            if sf in filelist:
-                if ext == ".zip":
-                    mtdtext = archive.read(sf)
-                else:
-                    mtdtext = tar.extractfile(sf).read()
-                # with open(sf, encoding="utf8", errors='ignore') as f:
-                #     mtdtext = f.read()
-                for p in level_patterns:
-                    level = re.search(p, mtdtext)
+        level = None
+        budget = max_bytes
+        filelist = set(archive_names(archive))
+        for folder in level_file_folders(productid):
+            for sf in searchfiles:
+                sf = folder + "/" + sf if folder else sf
+                if budget > 0 and sf in filelist:
+                    with open_archive_member(archive, sf) as f:
+                        header = f.read(budget)
+                    budget -= len(header)
+                    metrics.count("bytes_read", len(header))
+                    level = search_level(header)
                     if level:
-                        level = level.group(0)
                         break
-    elif not level[1:] == "L":
-        level = "L"+level
+            if level:
+                break
+    else:
+        level = normalize_level(level)
     if level == None: level = 'Not available'
     return level
 
 
-def organize(theline,output,full_img_path, ds, footprint):
-    timestr, timeobj = parse_time(theline[1], theline[2])
-    nf = folder_structure(output, get_level(full_img_path, theline), timeobj, ds, footprint)
-    img = os.path.basename(full_img_path)
-    img_newpath = os.path.join(nf, img)
+def reflink_file(src, dst):
+    import fcntl
+    FICLONE = 0x40049409
+    with open(src, "rb") as fsrc, open(dst, "wb") as fdst:
+        fcntl.ioctl(fdst.fileno(), FICLONE, fsrc.fileno())
+
+
+def copy_digest_file(src, dst, digest):
+    with open(src, "rb") as fsrc, open(dst, "wb") as fdst:
+        for block in iter(lambda: fsrc.read(1 << 20), b""):
+            digest.update(block)
+            fdst.write(block)
+
+
+def copy_file_range_file(src, dst):
+    with open(src, "rb") as fsrc, open(dst, "wb") as fdst:
+        remaining = os.fstat(fsrc.fileno()).st_size
+        while remaining > 0:
+            copied = os.copy_file_range(fsrc.fileno(), fdst.fileno(), remaining)
+            if copied == 0:
+                raise OSError(errno.EIO, "copy_file_range stopped early", src)
+            remaining -= copied
+
+
+@timed_stage("transfer")
+def transfer_file(src, dst, method="auto", allow_move=False, digest=None):
+    '''Store src as dst with the requested method, or the cheapest one that works
+    when it is auto, falling back to a plain copy. Returns the method used. The
+    bytes go into digest too: as they are copied, or read once from the source
+    when the kernel or filesystem does the copy.'''
+    size = os.path.getsize(src)
+    if method == "auto":
+        candidates = ["hardlink", "reflink", "copy_file_range"]
+        if allow_move: candidates.insert(0, "rename")
+    else:
+        candidates = [method]
+    if not "copy" in candidates:
+        candidates.append("copy")
+    for candidate in candidates:
+        if candidate == "rename" and not allow_move:
+            continue
+        # copies land on a temporary name, so dst is either complete or absent
+        tmp_dst = dst if candidate in ("rename", "hardlink") else dst + ".part"
+        try:
+            if candidate == "rename":
+                os.rename(src, tmp_dst)
+            elif candidate == "hardlink":
+                os.link(src, tmp_dst)
+            elif candidate == "reflink":
+                reflink_file(src, tmp_dst)
+            elif candidate == "copy_file_range":
+                copy_file_range_file(src, tmp_dst)
+            elif digest != None:
+                copy_digest_file(src, tmp_dst, digest)
+            else:
+                shutil.copyfile(src, tmp_dst)
+            if os.path.getsize(tmp_dst) != size:
+                raise OSError(errno.EIO, "size mismatch after " + candidate, tmp_dst)
+            if tmp_dst != dst:
+                os.replace(tmp_dst, dst)
+            metrics.count("bytes_written" if tmp_dst != dst else "bytes_linked", size)
+            if digest != None and candidate != "copy":
+                digest_file(dst if candidate == "rename" else src, digest)
+            return candidate
+        except (OSError, AttributeError, ImportError) as e:
+            logging.info("Could not " + candidate + " " + src + ": " + str(e))
+            if tmp_dst != dst and os.path.exists(tmp_dst):
+                os.remove(tmp_dst)
+            if candidate == "copy":
+                raise
+    return None
+
+
+def organized_path(record, output, plain_tar=False):
+    date = record.start_date
+    img_newpath = os.path.join(output, record.dataset, str(date.year), "{0:0=2d}".format(date.month),
+                               "{0:0=2d}".format(date.day), os.path.basename(record.path))
+    if not record.archive:
+        img_newpath += ".tar" if plain_tar else ".tgz"
+    return img_newpath
+
+
+@timed_stage("organize")
+def organize(record, output, compress_level=9, compress_threads=1, plain_tar=False, transfer="auto", remove=False,
+             checksum=None, tree=None):
+    '''Store the product in output/dataset/YYYY/MM/DD. Returns the new path ('' when it
+    was already there), how it got there and, with a checksum algorithm, the
+    "algorithm:hexdigest" of the new file (N/A otherwise). With an OutputTree the
+    existence check and folder creation go through it, and the new file is added.'''
+    img_newpath = organized_path(record, output, plain_tar)
+    if tree == None:
+        # concurrent workers may create the same levels at the same time
+        os.makedirs(os.path.dirname(img_newpath), exist_ok=True)
+        exists = os.path.exists(img_newpath)
+    else:
+        exists = tree.exists(img_newpath)
     zippedimg = ''
-    if not os.path.exists(img_newpath):
-        ext = os.path.splitext(full_img_path)[-1]
-        if ext in zipped:
-            zippedimg = img_newpath
-            os.chdir(os.path.dirname(full_img_path))
-            shutil.copyfile(full_img_path, img_newpath)
+    method = "N/A"
+    digest = None if checksum == None else hashlib.new(checksum)
+    if not exists:
+        zippedimg = img_newpath
+        if tree != None:
+            tree.make_dirs(os.path.dirname(img_newpath))
+        if record.archive:
+            method = transfer_file(record.path, img_newpath, transfer, remove, digest)
+            size = record.size
+            if remove and method != "rename":
+                os.remove(record.path)
         else:
-            zippedimg = img_newpath + ".tgz"
-            os.chdir(full_img_path)
-            make_tarfile(zippedimg, full_img_path)
+            size = make_tarfile(zippedimg, record.path, None if plain_tar else compress_level, compress_threads, digest)
+            method = "tar" if plain_tar else "tgz"
+            if remove:
+                shutil.rmtree(record.path)
         #
         # shutil.copytree(full_img_path, img_newpath)  ##Uncomment if you want to copy also the original img folder into the new destination
-        # tar_string = "tar czf " + zippedimg + " *"
-        # readout2 = subprocess.Popen(tar_string, shell=True, stdout=subprocess.PIPE, stderr=subprocess.PIPE,
-        #                             bufsize=1).communicate()[0]
-    return zippedimg
+    if zippedimg == '' or digest == None:
+        checksum = "N/A"
+    else:
+        checksum = checksum + ":" + digest.hexdigest()
+    if zippedimg != '' and tree != None:
+        tree.add(zippedimg, size, record.level, None if checksum == "N/A" else checksum)
+    return zippedimg, method, checksum
+
+
+def add_to_manifest(dest, checksum):
+    '''Append the checksum of an organized output to the manifest of its day
+    folder, in the format of sha256sum and friends so they can check it.'''
+    algorithm, hexdigest = checksum.split(":", 1)
+    with open(os.path.join(os.path.dirname(dest), "MANIFEST." + algorithm), "a") as f:
+        f.write(hexdigest + "  " + os.path.basename(dest) + "\n")
+
+
+def in_manifest(dest, algorithm):
+    path = os.path.join(os.path.dirname(dest), "MANIFEST." + algorithm)
+    if not os.path.isfile(path):
+        return False
+    with open(path) as f:
+        return any(line.rstrip("\n").split("  ", 1)[-1] == os.path.basename(dest) for line in f)
 
 
 def handle_zipped_input(src):
@@ -241,14 +1324,81 @@ def handle_zipped_input(src):
         unzipped = False
         src_dir = src
         dst_dir = src
-    if os.path.exists(src):
-        img = os.path.basename(src_dir)
-        return img, src_dir, dst_dir, unzipped
+    # the inputs were found when they were listed, gather_product stats them
+    img = os.path.basename(src_dir)
+    return img, src_dir, dst_dir, unzipped
+
+
+class ParallelGzipWriter:
+    """Write-only file object compressing fixed size blocks on a thread pool.
+    Every block becomes its own gzip member, so the output is a standard
+    multi-member gzip stream that gzip and tar read as usual."""
+
+    def __init__(self, fileobj, compresslevel=9, threads=2, block_size=1 << 20):
+        self.fileobj = fileobj
+        self.compresslevel = compresslevel
+        self.block_size = block_size
+        self.buffer = bytearray()
+        self.pending = collections.deque()
+        self.max_pending = threads * 2
+        self.executor = concurrent.futures.ThreadPoolExecutor(threads)
 
+    def _submit(self, block):
+        self.pending.append(self.executor.submit(gzip.compress, block, self.compresslevel, mtime=0))
+        # bound the blocks in memory, writing them out in order
+        while len(self.pending) > self.max_pending:
+            self.fileobj.write(self.pending.popleft().result())
 
-def make_tarfile(output_filename, source_dir):
-    with tarfile.open(output_filename, "w:gz") as tar:
-        tar.add(source_dir, arcname=os.path.basename(source_dir))
+    def write(self, data):
+        self.buffer += data
+        while len(self.buffer) >= self.block_size:
+            self._submit(bytes(self.buffer[:self.block_size]))
+            del self.buffer[:self.block_size]
+        return len(data)
+
+    def close(self):
+        if self.buffer or not self.pending:
+            self._submit(bytes(self.buffer))
+            self.buffer = bytearray()
+        while self.pending:
+            self.fileobj.write(self.pending.popleft().result())
+        self.executor.shutdown()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+@timed_stage("compress")
+def make_tarfile(output_filename, source_dir, compresslevel=9, threads=1, digest=None):
+    '''Tar source_dir into output_filename, gzipped at compresslevel (plain tar
+    when it is None) on the given number of threads. The archive is written to
+    output_filename.part and only renamed once complete. Its bytes also go into
+    digest, when given, on their way to the file. Returns the archive size.'''
+    part_filename = output_filename + ".part"
+    try:
+        with open(part_filename, "wb") as f:
+            out = f if digest == None else HashingWriter(f, digest)
+            if compresslevel == None:
+                with tarfile.open(part_filename, "w", fileobj=out) as tar:
+                    tar.add(source_dir, arcname=os.path.basename(source_dir))
+            elif threads > 1:
+                with ParallelGzipWriter(out, compresslevel, threads) as gz:
+                    with tarfile.open(fileobj=gz, mode="w|") as tar:
+                        tar.add(source_dir, arcname=os.path.basename(source_dir))
+            else:
+                with tarfile.open(part_filename, "w:gz", fileobj=out, compresslevel=compresslevel) as tar:
+                    tar.add(source_dir, arcname=os.path.basename(source_dir))
+    except BaseException:
+        if os.path.exists(part_filename):
+            os.remove(part_filename)
+        raise
+    size = os.path.getsize(part_filename)
+    metrics.count("bytes_written", size)
+    os.replace(part_filename, output_filename)
+    return size
 
 
 # def make_tarfile(output_filename, source_dir):
@@ -264,68 +1414,176 @@ def make_tarfile(output_filename, source_dir):
 #             tar.add(source_dir, arcname="")
 
 
+def has_product_files(filenames):
+    for filename in filenames:
+        for g in product_markers:
+            if filename.find(g)>=0:
+                return True
+    return False
+
+
+@functools.lru_cache(maxsize=4096)
+def is_product_dir(path):
+    # cached, the lines of a list often name several files of the same product
+    with os.scandir(path) as entries:
+        return has_product_files(entry.name for entry in entries)
+
+
 def get_right_img_dir(strg):
-    oexts = [".l1a", "IMAGE", ".dat"] #, "LEADER"]
     fstring = ''
     if strg[-4:] in zipped:
         fstring = strg
     else:
         if os.path.isfile(strg):
-            for filename in os.listdir(os.path.dirname(strg)):
-                for g in oexts:
-                    if filename.find(g)>=0:
-                        fstring = os.path.dirname(strg)
-                        break
+            if is_product_dir(os.path.dirname(strg)):
+                fstring = os.path.dirname(strg)
         elif os.path.isdir(strg) and strg[-5:] == ".SHRK":
             for folder, subfolders, files in os.walk(strg):
-                if folder != strg:
-                    for filename in files:
-                        for g in oexts:
-                            if filename.find(g) >= 0:
-                                fstring = strg
-                                break
+                if folder != strg and has_product_files(files):
+                    fstring = strg
+                    break
         elif os.path.isdir(strg):
-            for filename in os.listdir(strg):
-                for g in oexts:
-                    if filename.find(g)>=0:
-                        fstring = strg
-                        break
+            if is_product_dir(strg):
+                fstring = strg
     return fstring
 
 
-def list_products(records_csv, product, processed_successfully, footprint, dest_dir, proc_level):
+def scan_products(root):
+    '''Walk root with os.scandir and yield the products below it, telling them
+    apart from the single listing of each folder: archives, .SHRK folders and
+    folders holding .l1a/IMAGE/.dat files are products and are not descended into.'''
+    try:
+        with os.scandir(root) as it:
+            entries = sorted(it, key=lambda entry: entry.name)
+    except OSError as e:
+        logging.info("Could not scan " + root + ": " + str(e))
+        return
+    if has_product_files(entry.name for entry in entries):
+        yield root
+        return
+    for entry in entries:
+        if entry.is_dir():
+            if entry.name[-5:] == ".SHRK":
+                yield entry.path
+            else:
+                yield from scan_products(entry.path)
+        elif entry.name[-4:] in zipped:
+            yield entry.path
+
+
+class BufferedSink:
+    """Text output that is flushed at most every flush_interval seconds instead
+    of at every write."""
+
+    def __init__(self, f, flush_interval=5.0, close_file=True):
+        self.f = f
+        self.flush_interval = flush_interval
+        self.close_file = close_file
+        self.last_flush = time.monotonic()
+
+    def write(self, text):
+        self.f.write(text)
+        now = time.monotonic()
+        if now - self.last_flush >= self.flush_interval:
+            self.flush()
+
+    def flush(self):
+        self.f.flush()
+        self.last_flush = time.monotonic()
+
+    def close(self):
+        self.f.flush()
+        if self.close_file:
+            self.f.close()
+
+
+def open_sink(path, flush_interval):
+    return BufferedSink(open(path, 'a', buffering=1 << 20, newline=''), flush_interval)
+
+
+class MetadataOutput:
+    """Writes the metadata of every product as key=value blocks, JSON Lines, CSV
+    or TSV, either to stdout or to one batch file per dataset."""
+
+    def __init__(self, fmt="kv", flush_interval=5.0, batch_dir=None, stamp=None):
+        self.fmt = fmt
+        self.flush_interval = flush_interval
+        self.batch_dir = batch_dir
+        self.stamp = stamp or datetime.datetime.now().strftime('%Y%m%d%H%M%S')
+        self.sinks = {}
+
+    def _sink(self, dataset):
+        key = dataset if self.batch_dir != None else None
+        if not key in self.sinks:
+            if key == None:
+                sink = BufferedSink(sys.stdout, self.flush_interval, close_file=False)
+                new_file = True
+            else:
+                ext = {"kv": "txt", "jsonl": "jsonl", "csv": "csv", "tsv": "tsv"}[self.fmt]
+                path = os.path.join(self.batch_dir, dataset + "_" + self.stamp + "." + ext)
+                new_file = not os.path.exists(path)
+                sink = open_sink(path, self.flush_interval)
+            writer = None
+            if self.fmt in ("csv", "tsv"):
+                writer = csv.writer(sink, delimiter="," if self.fmt == "csv" else "\t", lineterminator="\n")
+                if new_file: writer.writerow(output_fields)
+            self.sinks[key] = (sink, writer)
+        return self.sinks[key]
+
+    @timed_stage("output")
+    def write(self, fields):
+        sink, writer = self._sink(fields["dataset"])
+        if self.fmt == "kv":
+            sink.write(format_kv(fields) + "\n")
+        elif self.fmt == "jsonl":
+            sink.write(json.dumps(fields) + "\n")
+        else:
+            writer.writerow([fields[k] for k in output_fields])
+
+    def flush(self):
+        for sink, writer in self.sinks.values():
+            sink.flush()
+
+    def close(self):
+        for sink, writer in self.sinks.values():
+            sink.close()
+
+
+def list_products(records_csv, product, processed_successfully, footprint, dest_dir, proc_level, transfer="N/A", checksum="N/A"):
     if not records_csv == None:
-        line = product + "," + str(processed_successfully) + "," + str(footprint) + "," + str(dest_dir) + "," + str(proc_level)
-        f = open(records_csv, 'a+')
-        f.write(line+'\n')
-        f.close()
+        line = product + "," + str(processed_successfully) + "," + str(footprint) + "," + str(dest_dir) + "," + str(proc_level) + "," + str(transfer) + "," + str(checksum)
+        records_csv.write(line+'\n')
 
 
-def read_ief(img, img_path, ds):
-    ext = os.path.splitext(img_path)[-1]
-    if ext in zipped:
-        tar = tarfile.open(img_path)
-        try:
-            m = tar.extractfile(img + ".ief")
-        except:
-            m = tar.extractfile(img+ "/" + img + ".ief")
-        raw_contents = str(m.read())
-        tar.close()
-    else:
-        ief_file = os.path.join(img_path, img + ".ief")
-        m = open(ief_file, "r")
-        raw_contents = str(m.read())
+def report_records(records_csv, records):
+    '''Count the outcome rows of a product, add its new outputs to the day
+    manifests and write them to the records csv.'''
+    for record in records:
+        metrics.count_outcome(record[1])
+        if len(record) > 6 and record[6] != "N/A":
+            add_to_manifest(record[3], record[6])
+        list_products(records_csv, *record)
+
+
+def read_archive_ief(archive, img):
+    try:
+        m = read_archive_member(archive, img + ".ief")
+    except KeyError:
+        m = read_archive_member(archive, img + "/" + img + ".ief")
+    return str(m)
+
+
+def parse_ief(img, raw_contents):
+    '''Turn the contents of a product .ief file into a catalogue line.'''
     contents = raw_contents.replace("HRP","").replace("-", " -")
     # raw_footprint = f"{contents.split()[15]} {contents.split()[16]} {contents.split()[17]} {contents.split()[18]} {contents.split()[19]} {contents.split()[20]} {contents.split()[21]} {contents.split()[22]}"
     if contents.find("CEOS_IEF")>=0:
         raw_footprint = ""
         for f in re.findall("\d+\.\d+", contents)[1:]:
             raw_footprint += f + " "
-        acq_station = "acquisition_station=" + contents.split()[9][:3]
-        start_orbit_no = contents.split()[9][6:11].replace('*****', '0').replace('?????', '0')
-        start_time = str(parse_time(contents.split()[6], contents.split()[7])[0])
-        stop_time = str(parse_time(contents.split()[6], contents.split()[8])[0])
-        theline = ("", contents.split()[6], contents.split()[7], contents.split()[8], "", "", "", "", raw_footprint)
+        acq_station = contents.split()[9][:3]
+        start_orbit_no = contents.split()[9][6:11]
+        theline = ("", contents.split()[6], contents.split()[7], contents.split()[8], "", acq_station, start_orbit_no, "", raw_footprint)
     else:
         dates = []
         times = []
@@ -337,155 +1595,725 @@ def read_ief(img, img_path, ds):
             if not x==None:
                 times.append(x[0])
         raw_footprint = "0"
-        acq_station = "acquisition_station=" + img[17:20]
-        start_orbit_no = contents.split()[7].replace('*****', '0').replace('?????', '0')
-        start_time = str(parse_time(dates[0], times[0])[0])
-        stop_time = str(parse_time(dates[0], times[1])[0])
-        theline = ("", dates[0], times[0], times[1], "", "", "", "", raw_footprint)
-    finalstrg = f"product={img}\n" \
-                f"dataset={ds}\n" \
-                f"{re.sub(' +', '_', acq_station)}\n" \
-                f"start_orbit_number={start_orbit_no}\n" \
-                f"size={str(get_size(img_path))}\n" \
-                f"start_time={start_time}\n" \
-                f"stop_time={stop_time}\n" \
-                f"footprint='{parse_footprint(raw_footprint)[0]}'"
-    return finalstrg, theline
+        acq_station = img[17:20]
+        start_orbit_no = contents.split()[7]
+        theline = ("", dates[0], times[0], times[1], "", acq_station, start_orbit_no, "", raw_footprint)
+    return theline
+
+
+def output_index_path(TMPDIR):
+    return os.path.join(TMPDIR, "avhrr_output_index.sqlite")
+
+
+class OutputTree:
+    """Index of the organized output tree (dataset/YYYY/MM/DD/file), kept up to
+    date by organize, so the existence checks of -O runs and the inventory of
+    a dataset or day do not stat or walk the tree. Day folders are created at
+    most once per run. Built from disk the first time it is used."""
+
+    def __init__(self, output, index_path, rebuild=False, check_same_thread=True, skip=None):
+        self.output = output
+        # a folder of output that is not part of the tree, the .tgz index cache
+        self.skip = skip
+        self.conn = sqlite3.connect(index_path, timeout=60, check_same_thread=check_same_thread)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        self.conn.execute("CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT)")
+        self.conn.execute("CREATE TABLE IF NOT EXISTS outputs (path TEXT PRIMARY KEY, dataset TEXT, day TEXT, "
+                          "size INTEGER, level TEXT, checksum TEXT, added TEXT)")
+        self.conn.execute("CREATE INDEX IF NOT EXISTS outputs_day ON outputs (dataset, day)")
+        self.conn.commit()
+        self.dirs = set()
+        if rebuild or self.conn.execute("SELECT 1 FROM meta WHERE key = 'built'").fetchone() == None:
+            self.rebuild()
+
+    def relative(self, path):
+        return os.path.relpath(path, self.output)
+
+    def exists(self, path):
+        return self.conn.execute("SELECT 1 FROM outputs WHERE path = ?", (self.relative(path),)).fetchone() != None
+
+    def make_dirs(self, folder):
+        if folder in self.dirs:
+            return
+        dataset, year, month, day = self.relative(folder).split(os.sep)[-4:]
+        # a day with outputs in the index has its folder already
+        if self.conn.execute("SELECT 1 FROM outputs WHERE dataset = ? AND day = ? LIMIT 1",
+                             (dataset, year + "-" + month + "-" + day)).fetchone() == None:
+            os.makedirs(folder, exist_ok=True)
+        self.dirs.add(folder)
+
+    def add(self, path, size, level=None, checksum=None):
+        rel = self.relative(path)
+        dataset, year, month, day = rel.split(os.sep)[:4]
+        self.conn.execute("INSERT OR REPLACE INTO outputs VALUES (?, ?, ?, ?, ?, ?, ?)",
+                          (rel, dataset, year + "-" + month + "-" + day, size, level, checksum,
+                           datetime.datetime.now().isoformat()))
+        self.conn.commit()
+
+    def rebuild(self):
+        '''Replace the index with what is on disk. The checksums come from the day
+        MANIFEST files, the levels from the previous index as the tree has none.'''
+        logging.info("Indexing the output tree " + self.output)
+        levels = dict(self.conn.execute("SELECT path, level FROM outputs WHERE level IS NOT NULL"))
+        rows = []
+        for dataset, year, month, day, folder in output_day_folders(self.output, self.skip):
+            checksums = {}
+            files = []
+            for entry in os.scandir(folder):
+                if entry.name.startswith("MANIFEST."):
+                    with open(entry.path) as f:
+                        for line in f:
+                            hexdigest, name = line.rstrip("\n").split("  ", 1)
+                            checksums[name] = entry.name[9:] + ":" + hexdigest
+                elif entry.is_file() and not entry.name.endswith(".part"):
+                    files.append((entry.name, entry.stat().st_size))
+            for name, size in files:
+                rel = os.path.join(dataset, year, month, day, name)
+                rows.append((rel, dataset, year + "-" + month + "-" + day, size, levels.get(rel), checksums.get(name), None))
+        with self.conn:
+            self.conn.execute("DELETE FROM outputs")
+            self.conn.executemany("INSERT OR REPLACE INTO outputs VALUES (?, ?, ?, ?, ?, ?, ?)", rows)
+            self.conn.execute("INSERT OR REPLACE INTO meta VALUES ('built', ?)", (datetime.datetime.now().isoformat(),))
+        self.dirs = set()
+        logging.info("Indexed " + str(len(rows)) + " outputs")
+
+    def inventory(self, prefix=""):
+        '''(path, size, level, checksum) of the outputs under prefix, a relative
+        path such as DATASET/YYYY/MM.'''
+        prefix = prefix.strip("/")
+        if prefix == "":
+            return self.conn.execute("SELECT path, size, level, checksum FROM outputs ORDER BY path").fetchall()
+        # the paths between prefix/ and prefix0, '0' sorting right after '/'
+        return self.conn.execute("SELECT path, size, level, checksum FROM outputs WHERE path = ? OR (path >= ? AND path < ?) "
+                                 "ORDER BY path", (prefix, prefix + "/", prefix + "0")).fetchall()
+
+    def close(self):
+        self.conn.close()
+
+
+def output_day_folders(output, skip=None):
+    '''(dataset, YYYY, MM, DD, path) of the day folders of the organized tree,
+    without the folder skip.'''
+    skip = None if skip == None else os.path.realpath(skip)
+    for dataset in os.scandir(output):
+        if not dataset.is_dir() or os.path.realpath(dataset.path) == skip:
+            continue
+        for year in os.scandir(dataset.path):
+            if not (year.is_dir() and len(year.name) == 4 and year.name.isdigit()):
+                continue
+            for month in os.scandir(year.path):
+                if not (month.is_dir() and len(month.name) == 2 and month.name.isdigit()):
+                    continue
+                for day in os.scandir(month.path):
+                    if day.is_dir() and len(day.name) == 2 and day.name.isdigit():
+                        yield dataset.name, year.name, month.name, day.name, day.path
+
+
+def journal_path(TMPDIR):
+    return os.path.join(TMPDIR, "avhrr_parser_journal.sqlite")
+
+
+def open_journal(path, check_same_thread=True):
+    journal = sqlite3.connect(path, timeout=60, check_same_thread=check_same_thread)
+    journal.execute("PRAGMA journal_mode=WAL")
+    journal.execute("PRAGMA synchronous=NORMAL")
+    journal.execute("CREATE TABLE IF NOT EXISTS journal (path TEXT PRIMARY KEY, size INTEGER, mtime INTEGER, "
+                    "status TEXT, dest TEXT, updated TEXT)")
+    journal.commit()
+    return journal
+
+
+def journal_done(journal, path, organized=False, st=None):
+    '''True when the journal records path as done with its current size and mtime
+    (and stored in the output tree, when organized).'''
+    if st == None:
+        st = os.stat(path)
+    row = journal.execute("SELECT size, mtime, status, dest FROM journal WHERE path = ?",
+                          (os.path.abspath(path),)).fetchone()
+    return row != None and row[0] == st.st_size and row[1] == st.st_mtime_ns and row[2] == "done" \
+        and (row[3] != None or not organized)
+
+
+def journal_mark(journal, path, status, dest=None, st=None):
+    if journal == None:
+        return
+    if st == None:
+        st = os.stat(path)
+    # keyed on absolute paths, so runs from other folders or with other
+    # spellings of the same path share the entries
+    if dest != None:
+        dest = os.path.abspath(dest)
+    journal.execute("INSERT OR REPLACE INTO journal VALUES (?, ?, ?, ?, ?, ?)",
+                    (os.path.abspath(path), st.st_size, st.st_mtime_ns, status, dest, datetime.datetime.now().isoformat()))
+    journal.commit()
+
+
+def recover_journal(journal, checksum=None):
+    '''Settle the products an earlier run was interrupted on. They lose their
+    .part file and are marked failed, so they are retried and their metadata
+    is written again. Every writer of the output tree finishes with an atomic
+    rename or link, so an existing dest is complete and kept: the retry finds
+    it in place, and it gets its MANIFEST.<checksum> line here when it misses
+    one. With -r the input may be gone and dest the only copy left, those
+    are marked done.'''
+    for path, dest in journal.execute("SELECT path, dest FROM journal WHERE status = 'started'").fetchall():
+        status = 'failed'
+        if dest:
+            if os.path.isfile(dest + ".part"):
+                logging.info("Removing partial output " + dest + ".part")
+                os.remove(dest + ".part")
+            if os.path.isfile(dest):
+                logging.info("Keeping complete output " + dest)
+                if checksum != None and not in_manifest(dest, checksum):
+                    add_to_manifest(dest, checksum + ":" + file_checksum(dest, checksum))
+                if not os.path.exists(path):
+                    status = 'done'
+        journal.execute("UPDATE journal SET status = ? WHERE path = ?", (status, path))
+    journal.commit()
+
+
+def journal_written(journal, written, output, records_csv):
+    '''Flush the metadata and records outputs, then mark the products of
+    written, (path, dest, st) as returned by process_product, done. Until then
+    an interrupted run leaves them to be retried.'''
+    output.flush()
+    if records_csv != None:
+        records_csv.flush()
+    for path, dest, st in written:
+        journal_mark(journal, path, "done", dest, st)
+
+
+def catalogue_index_path(TMPDIR):
+    return os.path.join(TMPDIR, "NOAA_sat_mtd.sqlite")
+
+
+def unique_inputs(candidates):
+    '''Pass on the (line, img, ...) candidates, dropping products already seen.'''
+    repeated = set()
+    for candidate in candidates:
+        img = candidate[1]
+        if img != '':
+            if os.path.basename(img) in repeated:
+                continue
+            repeated.add(os.path.basename(img))
+        yield candidate
+
+
+def list_inputs(avhrr_list):
+    '''Yield (line, None) for every line of the products list as it is read,
+    img is left to classify_input.'''
+    with open(avhrr_list) as f:
+        for line in f:
+            yield os.path.normpath(line.rstrip()), None
+
+
+def classify_input(line):
+    '''The img of a line of the products list, '' when it has not the expected
+    structure and None when it is neither a file nor a folder.'''
+    if os.path.isfile(line) or os.path.isdir(line):
+        return get_right_img_dir(line)
+    return None
+
+
+def classify_inputs(inputs):
+    for line, img in inputs:
+        if img == None:
+            img = classify_input(line)
+            if img == None:
+                continue
+        yield line, img
+
+
+def scan_inputs(root):
+    for path in scan_products(root):
+        yield path, path
+
+
+def input_product_id(img):
+    name = os.path.basename(img)
+    ext = os.path.splitext(name)[-1]
+    if ext in zipped:
+        return name[:-4]
+    return name
+
+
+def gather_product(img, args, catalogue, journal=None):
+    '''The reads of one input product: stat, journal and catalogue lookups, size
+    and level headers. Returns (st, done, record), record None when the product
+    is not in the catalogue. Changes nothing, so it can run ahead on other threads.'''
+    productid = input_product_id(img)
+    img, full_img_path, dest_dir, unzipped = handle_zipped_input(img)
+    st = os.stat(full_img_path)
+    if args.resume and journal != None and journal_done(journal, full_img_path, args.O, st):
+        return st, True, None
+    if args.d:
+        theline = None
+    else:
+        theline = lookup_product(catalogue, productid)
+        if theline == None:
+            return st, False, None
+    record = inspect_product(productid, full_img_path, theline, args.ds, args.f, args.header_bytes, args.tgz_index)
+    return st, False, record
+
+
+def process_product(line, img, args, catalogue, journal=None, gathered=None, tree=None):
+    '''Process one input product. Returns its metadata fields (None when nothing
+    is printed), the rows to add to the records csv and, for a processed
+    product, the (path, dest, st) that journal_written marks done once those
+    outputs are written. gathered is the result
+    of the product's gather_product when it was read ahead, tree the OutputTree
+    of -O with --output_index.'''
+    finalstrg = None
+    records = []
+    if img == '':
+        logging.info("---Processing product " + line)
+        logging.info("Product was not found or doesn't have the expected file structure!")
+        records.append((line, "not found or no structure", "N/A", "N/A", "N/A"))
+        return finalstrg, records, None
+    name, full_img_path, dest_dir, unzipped = handle_zipped_input(img)
+    logging.info("---Processing product " + full_img_path)
+    if gathered == None:
+        st, done, record = gather_product(img, args, catalogue, journal)
+    else:
+        st, done, record = gathered
+    if done:
+        logging.info("Product was already processed in an earlier run")
+        records.append((full_img_path, "already processed", "N/A", "N/A", "N/A"))
+        return finalstrg, records, None
+    if record == None:
+        logging.info("Product was not found in the CSVs!")
+        records.append((full_img_path, "not found in the CSVs", "N/A", "N/A", "N/A"))
+        journal_mark(journal, full_img_path, "not found", st=st)
+        return finalstrg, records, None
+    finalstrg = product_fields(record)
+    if record.level == "Not available":
+        logging.info("Could not find the processing level for the product.")
+    if not record.footprint_ok:
+        logging.info("Product has no footprint")
+    if not args.O: records.append((record.path, "Metadata", record.footprint_ok, "N/A", record.level))
+    logging.info("Metadata was successfully printed to stdout")
+    if args.O:
+        dest = organized_path(record, args.output, args.tar)
+        if not (os.path.exists(dest) if tree == None else tree.exists(dest)):
+            journal_mark(journal, full_img_path, "started", dest, st)
+        try:
+            zippedimg, method, checksum = organize(record, args.output, args.compress_level, args.compress_threads,
+                                                   args.tar, args.transfer, args.r, args.checksum, tree)
+        except (OSError, tarfile.TarError) as e:
+            logging.info("Could not store the product: " + str(e))
+            records.append((record.path, "failed", record.footprint_ok, dest, record.level))
+            journal_mark(journal, full_img_path, "failed", dest, st)
+            return finalstrg, records, None
+        logging.info("Product was stored into " + zippedimg + " (" + method + ")")
+        records.append((record.path, "Re-organized", record.footprint_ok, zippedimg, record.level, method, checksum))
+        return finalstrg, records, (full_img_path, dest, st)
+    if args.r and unzipped:
+        shutil.rmtree(full_img_path)
+    return finalstrg, records, (full_img_path, None, st)
+
+
+class ReadAhead:
+    """Runs classify_input and gather_product for the next products on a few
+    threads while the current one is organized and written, so the stat,
+    listing and header reads of network storage overlap. At most two products
+    per thread are read ahead, which bounds the memory held and how far the
+    reads run ahead."""
+
+    def __init__(self, args, threads, index_path=None):
+        self.args = args
+        self.threads = threads
+        self.catalogue = None if index_path == None else CatalogueHandle(index_path)
+        self.local = threading.local()
+
+    def gather(self, line, img):
+        if img == None:
+            img = classify_input(line)
+        if not img:
+            return img, None
+        # sqlite connections stay on the thread that opened them
+        if self.args.resume and getattr(self.local, "journal", None) == None:
+            self.local.journal = open_journal(journal_path(self.args.output))
+        catalogue = None if self.catalogue == None else self.catalogue.connection()
+        return img, gather_product(img, self.args, catalogue, getattr(self.local, "journal", None))
+
+    def products(self, inputs):
+        '''Yield (line, img, result of gather_product) in input order, dropping
+        the lines classify_input finds no file or folder for.'''
+        executor = concurrent.futures.ThreadPoolExecutor(self.threads, thread_name_prefix="read_ahead")
+        window = collections.deque()
+        try:
+            for line, img in inputs:
+                window.append((line, executor.submit(self.gather, line, img)))
+                if len(window) > 2 * self.threads:
+                    line, future = window.popleft()
+                    img, gathered = future.result()
+                    if img != None:
+                        yield line, img, gathered
+            while window:
+                line, future = window.popleft()
+                img, gathered = future.result()
+                if img != None:
+                    yield line, img, gathered
+        finally:
+            executor.shutdown(cancel_futures=True)
+
+
+def init_worker(args, index_path, log_queue):
+    global worker_args, worker_catalogue, worker_journal, worker_tree
+    root = logging.getLogger()
+    for handler in root.handlers[:]:
+        root.removeHandler(handler)
+    root.addHandler(logging.handlers.QueueHandler(log_queue))
+    root.setLevel(logging.INFO)
+    # forked with the metrics of the parent, only this worker's work is sent back
+    metrics.reset()
+    worker_args = args
+    worker_catalogue = sqlite3.connect(index_path) if index_path else None
+    worker_journal = open_journal(journal_path(args.output))
+    worker_tree = None if args.output_index == None else OutputTree(args.output, args.output_index, skip=args.tgz_index)
+
+
+def run_worker(item):
+    line, img = item
+    fields, records, done = process_product(line, img, worker_args, worker_catalogue, worker_journal, tree=worker_tree)
+    return fields, records, done, metrics.drain()
+
+
+class CatalogueHandle:
+    """Per-thread connections to the catalogue index, reopened once the index
+    file has been swapped for a refreshed one."""
+
+    def __init__(self, index_path):
+        self.index_path = index_path
+        self.local = threading.local()
+        self.lock = threading.Lock()
+        self.connections = set()
+
+    def connection(self):
+        st = os.stat(self.index_path)
+        key = (st.st_ino, st.st_mtime_ns)
+        if getattr(self.local, "key", None) != key:
+            if getattr(self.local, "conn", None) != None:
+                self.local.conn.close()
+                with self.lock:
+                    self.connections.discard(self.local.conn)
+            # only used by this thread, close() may run on another one
+            self.local.conn = sqlite3.connect(self.index_path, check_same_thread=False)
+            self.local.key = key
+            with self.lock:
+                self.connections.add(self.local.conn)
+        return self.local.conn
+
+    def close(self):
+        with self.lock:
+            for conn in self.connections:
+                conn.close()
+            self.connections = set()
+
+
+class UnsupportedRequest(Exception):
+    """A request the server cannot answer as the command line would, the client
+    runs the parser itself instead."""
+
+
+# the command line flags a request may set, the rest come from the server
+request_flags = ["d", "O", "f", "r", "l"]
+# HTTP is reachable by any local user and browser page, it only gets the flags
+# that change nothing on disk, -O, -r and -l stay on the Unix socket
+http_request_flags = ["d", "f"]
+
+
+class ProductService:
+    """State kept by the server between requests: the catalogue, the journal
+    connections and the records csv."""
+
+    def __init__(self, args, records_csv):
+        self.args = args
+        self.records_csv = records_csv
+        self.records_lock = threading.Lock()
+        self.catalogue = None if args.d else CatalogueHandle(catalogue_index_path(args.output))
+        self.local = threading.local()
+        self.lock = threading.Lock()
+        self.opened = []
+
+    def refresh(self):
+        prepare_datafiles(self.args.noaa_mtd, self.args.output).close()
+
+    def describe(self, avhrr_file, ds=None, flags={}):
+        '''Return the key=value block the command line prints for avhrr_file, run
+        with the request_flags set in flags.'''
+        if avhrr_file.startswith("file://"):
+            avhrr_file = local_source_path(avhrr_file)
+        args = argparse.Namespace(**vars(self.args))
+        if ds: args.ds = ds
+        for flag in request_flags:
+            setattr(args, flag, bool(flags.get(flag)))
+        if not args.d and self.catalogue == None:
+            raise UnsupportedRequest("the server runs with -d and has no catalogue")
+        if args.l and self.records_csv == None:
+            raise UnsupportedRequest("the server runs without -l")
+        if getattr(self.local, "journal", None) == None:
+            # opened once per pool thread, closed by close()
+            self.local.journal = open_journal(journal_path(args.output), check_same_thread=False)
+            self.local.tree = None if args.output_index == None else \
+                OutputTree(args.output, args.output_index, check_same_thread=False, skip=args.tgz_index)
+            with self.lock:
+                self.opened += [c for c in (self.local.journal, self.local.tree) if c != None]
+        catalogue = None if self.catalogue == None else self.catalogue.connection()
+        img = avhrr_file if os.path.exists(avhrr_file) else ''
+        fields, records, done = process_product(avhrr_file, img, args, catalogue, self.local.journal, tree=self.local.tree)
+        with self.records_lock:
+            report_records(self.records_csv if args.l else None, records)
+            # nothing else writes to it before the next request, which may never come
+            if args.l:
+                self.records_csv.flush()
+        if done != None:
+            journal_mark(self.local.journal, done[0], "done", done[1], done[2])
+        return "" if fields == None else format_kv(fields) + "\n"
+
+    def close(self):
+        with self.lock:
+            for opened in self.opened:
+                opened.close()
+            self.opened = []
+        if self.catalogue != None:
+            self.catalogue.close()
+
+
+class SocketRequestHandler(socketserver.StreamRequestHandler):
+    # one JSON line {"avhrr_file": ..., "ds": ..., "flags": {"d": true, ...}} in, the metadata block out
+
+    def handle(self):
+        try:
+            request = json.loads(self.rfile.readline().decode("utf8"))
+            response = self.server.service.describe(request["avhrr_file"], request.get("ds"), request.get("flags", {}))
+        except UnsupportedRequest as e:
+            response = "unsupported=" + str(e) + "\n"
+        except Exception as e:
+            logging.info("Request failed: " + repr(e))
+            response = "error=" + str(e).replace("\n", " ") + "\n"
+        self.wfile.write(response.encode("utf8"))
+
+
+class HTTPRequestHandler(http.server.BaseHTTPRequestHandler):
+
+    def do_GET(self):
+        url = urllib.parse.urlparse(self.path)
+        query = urllib.parse.parse_qs(url.query)
+        if url.path != "/metadata" or not "avhrr_file" in query:
+            self.send_error(400, "expected /metadata?avhrr_file=PATH")
+            return
+        flags = dict((flag, query.get(flag, ["0"])[0] not in ("", "0")) for flag in request_flags)
+        if any(flags[flag] for flag in request_flags if not flag in http_request_flags):
+            self.send_error(403, "only " + ", ".join(http_request_flags) + " are accepted over HTTP")
+            return
+        try:
+            response = self.server.service.describe(query["avhrr_file"][0], query.get("ds", [None])[0], flags)
+            code = 200 if response else 404
+        except UnsupportedRequest as e:
+            response, code = "unsupported=" + str(e) + "\n", 501
+        except Exception as e:
+            logging.info("Request failed: " + repr(e))
+            response, code = "error=" + str(e) + "\n", 500
+        body = response.encode("utf8")
+        self.send_response(code)
+        self.send_header("Content-Type", "text/plain; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        logging.info("HTTP " + format % args)
+
+
+class PooledServerMixIn:
+    """Handles the requests on a fixed pool of threads shared by the servers,
+    instead of a thread per request, so the connections ProductService keeps
+    per thread are opened once and reused."""
+
+    pool = None
+
+    def process_request(self, request, client_address):
+        self.pool.submit(self.process_request_thread, request, client_address)
+
+    def process_request_thread(self, request, client_address):
+        try:
+            self.finish_request(request, client_address)
+        except Exception:
+            self.handle_error(request, client_address)
+        finally:
+            self.shutdown_request(request)
+
+
+class PooledUnixServer(PooledServerMixIn, socketserver.UnixStreamServer):
+    pass
+
+
+class PooledHTTPServer(PooledServerMixIn, http.server.HTTPServer):
+    pass
+
+
+def serve(args, records_csv):
+    '''Answer product requests until interrupted, keeping the catalogue loaded
+    and refreshing it every args.refresh_interval seconds.'''
+    service = ProductService(args, records_csv)
+    socket_path = args.socket or os.path.join(args.output, "avhrr_parser.sock")
+    if os.path.exists(socket_path):
+        with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as probe:
+            try:
+                probe.connect(socket_path)
+            except OSError:
+                # left behind by a server that did not stop cleanly
+                os.remove(socket_path)
+            else:
+                logging.info("A server already answers on " + socket_path)
+                raise SystemExit("A server already answers on " + socket_path)
+    pool = concurrent.futures.ThreadPoolExecutor(args.serve_threads, thread_name_prefix="serve")
+    servers = [PooledUnixServer(socket_path, SocketRequestHandler)]
+    if args.http_port != None:
+        servers.append(PooledHTTPServer(("127.0.0.1", args.http_port), HTTPRequestHandler))
+    for server in servers:
+        server.service = service
+        server.pool = pool
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+    logging.info("Serving on " + socket_path + ("" if args.http_port == None else " and port " + str(args.http_port)))
+    stop = threading.Event()
+    try:
+        while not stop.wait(args.refresh_interval):
+            if service.catalogue != None:
+                service.refresh()
+            if args.metrics:
+                metrics.write_prometheus(args.metrics)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        for server in servers:
+            server.shutdown()
+            server.server_close()
+        pool.shutdown()
+        service.close()
+        os.remove(socket_path)
 
 
 if __name__ == '__main__':
-    #setup some variables
-    zipped = [".tar", ".tgz", ".tar.gz", ".zip"]
-    level_patterns = [r"LEVEL [0-1][AB_]", r"L[0-1][AB_]"]
-    searchfiles = ['catalogue.ief', 'catalogue.iuf', 'LEADER']
     args = setup_cmd_args()
     TMPDIR=args.output
-    logging.basicConfig(filename=os.path.join(TMPDIR,'avhrr_parser.log'), level=logging.INFO, format='INFO: %(asctime)s %(message)s', datefmt='%m/%d/%Y %I:%M:%S %p')
+    log_listener, log_handler = setup_logging(TMPDIR)
+    run_wall, run_cpu = time.perf_counter(), time.process_time()
     logging.info("------STARTED RUN------")
+    if args.tgz_index == "":
+        args.tgz_index = os.path.join(TMPDIR, "tgz_index")
+    if args.output_index == "" or (args.output_index == None and (args.rebuild_output_index or args.inventory != None)):
+        args.output_index = output_index_path(TMPDIR)
+    stamp = datetime.datetime.now().strftime('%Y%m%d%H%M%S')
     if args.l:
-        datetime_object = datetime.datetime.now()
-        records_csv = os.path.join(TMPDIR, 'avhrr_parser_' + datetime_object.strftime('%Y%m%d%H%M%S') + '.csv')
-        line = "Product,Processing,Footprint,New_dir,Processing_level"
-        f = open(records_csv, 'a+')
-        f.write(line+'\n')
-        f.close()
+        records_csv = open_sink(os.path.join(TMPDIR, 'avhrr_parser_' + stamp + '.csv'), args.flush_interval)
+        line = "Product,Processing,Footprint,New_dir,Processing_level,Transfer,Checksum"
+        records_csv.write(line+'\n')
     else:
         records_csv = None
-    #download and unzip the NOAA sats metadata files
-    if not os.path.isdir(os.path.join(TMPDIR,"NOAA_sat_mtd")):
-        NOAA_sat_mtd_dir=prepare_datafiles(args.noaa_mtd, TMPDIR)
-    else:
-        NOAA_sat_mtd_dir=os.path.join(TMPDIR, "NOAA_sat_mtd")
-    # NOAA_sat_mtd_dir = r"C:\Users\vbnunes\Downloads\Noaa_catalogue_1_1\Noaa_catalogue_1_1"
-    csv_files=os.listdir(NOAA_sat_mtd_dir)
-    csv_files_comp=[]
-    for f in csv_files:
-        csv_files_comp.append(os.path.join(NOAA_sat_mtd_dir,f))
-    if args.avhrr_list != None:
-        with open(args.avhrr_list) as f:
-            lines = f.readlines()
-            repeated = []
-            for line in lines:
-                repeated = list(set(repeated))
-                line = os.path.normpath(line.rstrip())
-                if os.path.isfile(line) or os.path.isdir(line):
-                    img = get_right_img_dir(line)
-                    if not os.path.basename(img) in repeated:
-                        if not img == '':
-                            img, full_img_path, dest_dir, unzipped = handle_zipped_input(img)
-                            repeated.append(img)
-                            # if not unzipped:
-                            #     img_path = os.path.dirname(full_img_path)
-                            # else:
-                            img_path = full_img_path
-                            logging.info("---Processing product " + full_img_path)
-                            ext = os.path.splitext(img_path)[-1]
-                            if ext in zipped:
-                                productid = img[:-4]
-                            else:
-                                productid = img
-                            if args.d:
-                                finalstrg, theline = read_ief(productid, img_path, args.ds)
-                            else:
-                                thecsv = find_right_csv(productid, csv_files_comp)
-                                if not thecsv==None:
-                                    theline = get_right_line(thecsv, productid)
-                                    if args.f:
-                                        finalstrg = compose_output(productid, img_path, theline, args.ds, parse_footprint(theline[8])[1])
-                                    else:
-                                        finalstrg = compose_output(productid, img_path, theline, args.ds, True)
-
-                                    if get_level(full_img_path, theline) == "Not available":
-                                        logging.info("Could not find the processing level for the product.")
-                                    if parse_footprint(theline[8])[1] == False:
-                                        logging.info("Product has no footprint")
-                                else:
-                                    finalstrg = ""
-                                    logging.info("Product was not found in the CSVs!")
-                                    list_products(records_csv, full_img_path, "not found in the CSVs", "N/A", "N/A", "N/A")
-                            print(finalstrg)
-                            if not args.O: list_products(records_csv, full_img_path, "Metadata", parse_footprint(theline[8])[1], "N/A",
-                                          get_level(full_img_path, theline))
-                            logging.info("Metadata was successfully printed to stdout")
-                            if args.O:
-                                if args.f:
-                                    zippedimg = organize(theline, args.output, full_img_path, args.ds, parse_footprint(theline[8])[1])
-                                else:
-                                    zippedimg = organize(theline, args.output, full_img_path, args.ds, True)
-                                logging.info("Product was stored into " + zippedimg)
-                                list_products(records_csv, full_img_path, "Re-organized", parse_footprint(theline[8])[1], zippedimg, get_level(full_img_path, theline))
-                            elif args.r and unzipped:
-                                shutil.rmtree(full_img_path)
-                        else:
-                            logging.info("---Processing product " + line)
-                            logging.info("Product was not found or doesn't have the expected file structure!")
-                            list_products(records_csv, line, "not found or no structure", "N/A", "N/A", "N/A")
+    output = MetadataOutput(args.format, args.flush_interval, TMPDIR if args.batch else None, stamp)
+    journal = open_journal(journal_path(TMPDIR))
+    if args.resume:
+        recover_journal(journal, args.checksum)
+    tree = None
+    if args.output_index != None:
+        tree = OutputTree(TMPDIR, args.output_index, args.rebuild_output_index, skip=args.tgz_index)
+    #refresh the NOAA sats metadata catalogue, only downloaded when the source changed
+    catalogue = None
+    query = args.bbox != None or args.polygon != None or args.start != None or args.stop != None
+    batch_join = args.batch_join and not (args.d or args.serve or query or args.inventory != None) \
+        and (args.scan != None or args.avhrr_list != None)
+    if (not args.d or query) and args.inventory == None and not batch_join:
+        catalogue = prepare_datafiles(args.noaa_mtd, TMPDIR, args.catalogue_check_interval)
+    if args.serve:
+        signal.signal(signal.SIGTERM, signal.default_int_handler)
+        serve(args, records_csv)
+        inputs = []
+    elif args.inventory != None:
+        writer = csv.writer(sys.stdout, lineterminator="\n")
+        writer.writerow(["Path", "Size", "Processing_level", "Checksum"])
+        for path, size, level, checksum in tree.inventory(args.inventory):
+            writer.writerow([path, size, level or "N/A", checksum or "N/A"])
+        inputs = []
+    elif query:
+        for theline in query_catalogue(catalogue, (args.bbox or []) + (args.polygon or []) or None, args.start, args.stop):
+            output.write(query_fields(theline, args.ds))
+        inputs = []
+    elif args.scan != None:
+        inputs = scan_inputs(os.path.normpath(args.scan))
+    elif args.avhrr_list != None:
+        inputs = list_inputs(args.avhrr_list)
     elif args.avhrr_file != None:
-        img, full_img_path, dest_dir, unzipped = handle_zipped_input(args.avhrr_file)
-        if not img == '':
-            img_path = full_img_path
-            logging.info("---Processing product " + full_img_path)
-            ext = os.path.splitext(img_path)[-1]
-            if ext in zipped:
-                productid = img[:-4]
-            else:
-                productid = img
-            if args.d:
-                finalstrg, theline = read_ief(productid, img_path, args.ds)
-            else:
-                thecsv = find_right_csv(productid, csv_files_comp)
-                # img_path = os.path.split(args.avhrr_file)[0]
-                # thecsv = find_right_csv(img, csv_files_comp)
-                if not thecsv == None:
-                    theline = get_right_line(thecsv, productid)
-                    # theline = get_right_line(thecsv, img)
-                    if args.f:
-                        finalstrg = compose_output(productid, img_path, theline, args.ds, parse_footprint(theline[8])[1])
-                    else:
-                        finalstrg = compose_output(productid, img_path, theline, args.ds, True)
-                    if get_level(full_img_path, theline) == "Not available":
-                        logging.info("Could not find the processing level for the product.")
-                    if parse_footprint(theline[8])[1] == False:
-                        logging.info("Product has no footprint")
-                else:
-                    finalstrg = ""
-                    logging.info("Product was not found in the CSVs!")
-                    list_products(records_csv, full_img_path, "not found in the CSVs", "N/A", "N/A", "N/A")
-            print(finalstrg)
-            if not args.O: list_products(records_csv, full_img_path, "Metadata", parse_footprint(theline[8])[1], "N/A", get_level(full_img_path, theline))
-            logging.info("Metadata was successfully printed to stdout")
-            if args.O:
-                if args.f:
-                    zippedimg = organize(theline, args.output, full_img_path, args.ds,
-                                         parse_footprint(theline[8])[1])
-                else:
-                    zippedimg = organize(theline, args.output, full_img_path, args.ds, True)
-                logging.info("Product was stored into " + zippedimg)
-                list_products(records_csv, full_img_path, "Re-organized", parse_footprint(theline[8])[1], zippedimg, get_level(full_img_path, theline))
-            elif args.r and unzipped:
-                shutil.rmtree(full_img_path)
+        inputs = [(args.avhrr_file, args.avhrr_file if os.path.exists(args.avhrr_file) else '')]
+    else:
+        inputs = []
+    index_path = None if args.d else catalogue_index_path(TMPDIR)
+    parallel = args.jobs > 1 and (args.avhrr_list != None or args.scan != None)
+    read_ahead = args.prefetch > 0 and not parallel
+    if batch_join or not read_ahead:
+        inputs = unique_inputs(classify_inputs(inputs))
+    # removed with its run files even when the run fails
+    join_dir = tempfile.mkdtemp(prefix="avhrr_batch_join_", dir=TMPDIR) if batch_join else None
+    try:
+        if batch_join:
+            inputs, index_path = batch_join_catalogue(args.noaa_mtd, inputs, join_dir, args.join_run_size)
+            catalogue = sqlite3.connect(index_path)
+        listener = None
+        if parallel:
+            # workers log through a queue, only this process writes avhrr_parser.log,
+            # the metadata output (in input order) and the records csv
+            log_queue = multiprocessing.Queue()
+            listener = logging.handlers.QueueListener(log_queue, log_handler)
+            listener.start()
+            pool = multiprocessing.Pool(args.jobs, initializer=init_worker,
+                                        initargs=(args, index_path, log_queue))
+            results = pool.imap(run_worker, inputs)
         else:
-            logging.info("---Processing product " + args.avhrr_file)
-            logging.info("Product was not found or doesn't have the expected file structure!")
-            list_products(records_csv, args.avhrr_file, "not found or no structure", "N/A", "N/A", "N/A")
-    logging.info("------ENDED RUN------")
\ No newline at end of file
+            pool = None
+            if read_ahead:
+                inputs = unique_inputs(ReadAhead(args, args.prefetch, index_path).products(inputs))
+            else:
+                inputs = ((line, img, None) for line, img in inputs)
+            results = (process_product(line, img, args, catalogue, journal, gathered, tree) + (None,) for line, img, gathered in inputs)
+        # products are journaled done once their outputs are flushed, at most
+        # every flush_interval seconds like the outputs themselves
+        written = []
+        last_written = time.monotonic()
+        try:
+            for fields, records, done, worker_metrics in results:
+                if worker_metrics != None:
+                    metrics.merge(worker_metrics)
+                if fields != None:
+                    output.write(fields)
+                report_records(records_csv, records)
+                if done != None:
+                    written.append(done)
+                if written and time.monotonic() - last_written >= args.flush_interval:
+                    journal_written(journal, written, output, records_csv)
+                    written = []
+                    last_written = time.monotonic()
+        finally:
+            output.close()
+            if records_csv != None:
+                records_csv.close()
+            # closed, so written
+            for path, dest, st in written:
+                journal_mark(journal, path, "done", dest, st)
+        if pool != None:
+            pool.close()
+            pool.join()
+            listener.stop()
+    finally:
+        if join_dir != None:
+            if catalogue != None:
+                catalogue.close()
+            shutil.rmtree(join_dir, ignore_errors=True)
+    # worker stage times add up across processes, run is the wall time of the whole run
+    metrics.add_stage("run", 1, time.perf_counter() - run_wall, time.process_time() - run_cpu)
+    logging.info("Run metrics:\n" + metrics.summary())
+    if args.metrics:
+        metrics.write_prometheus(args.metrics)
+    logging.info("------ENDED RUN------")
+    log_listener.stop()
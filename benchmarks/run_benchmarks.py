@@ -0,0 +1,188 @@
+import os
+import sys
+import csv
+import json
+import time
+import shutil
+import argparse
+import datetime
+import resource
+import statistics
+import subprocess
+import tempfile
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import avhrr_metadata_parser as amp
+import synthetic_data
+
+parser_script = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "avhrr_metadata_parser.py")
+
+
+def setup_cmd_args():
+    """Setup command line arguments."""
+    parser = argparse.ArgumentParser(description="Time the stages and end-to-end runs of avhrr_metadata_parser on synthetic data.", formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument("--work_dir", help="Folder for the synthetic data and outputs (default: a temporary folder)")
+    parser.add_argument("--results_dir", default="bench_results", help="Folder the results JSON is saved into")
+    parser.add_argument("--catalogue_rows", type=int, default=100000, help="Number of passes in the catalogue")
+    parser.add_argument("--products", type=int, default=10, help="Number of products per layout")
+    parser.add_argument("--product_size", type=int, default=1 << 20, help="Bytes of image data per product")
+    parser.add_argument("--repeat", type=int, default=3, help="Runs of every stage, the best one is kept")
+    parser.add_argument("--threads", type=int, default=4, help="Threads of the parallel make_tarfile stage")
+    parser.add_argument("--compare", nargs=2, metavar=("OLD", "NEW"), help="Compare two saved results instead of running")
+    return parser.parse_args()
+
+
+def timed(fn, repeat, ops=1):
+    walls = []
+    cpus = []
+    for _ in range(repeat):
+        wall, cpu = time.perf_counter(), time.process_time()
+        fn()
+        walls.append(time.perf_counter() - wall)
+        cpus.append(time.process_time() - cpu)
+    return {"wall": min(walls), "wall_median": statistics.median(walls), "cpu": min(cpus), "ops": ops}
+
+
+def timed_run(cmd, repeat, ops=1, setup=None):
+    walls = []
+    cpus = []
+    for _ in range(repeat):
+        if setup: setup()
+        before = resource.getrusage(resource.RUSAGE_CHILDREN)
+        wall = time.perf_counter()
+        subprocess.run(cmd, check=True, stdout=subprocess.DEVNULL)
+        walls.append(time.perf_counter() - wall)
+        after = resource.getrusage(resource.RUSAGE_CHILDREN)
+        cpus.append(after.ru_utime - before.ru_utime + after.ru_stime - before.ru_stime)
+    return {"wall": min(walls), "wall_median": statistics.median(walls), "cpu": min(cpus), "ops": ops}
+
+
+def git_commit():
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=os.path.dirname(parser_script),
+                              capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return "unknown"
+
+
+# the catalogue scan of the parser before the index, timed against catalogue_lookup
+def find_right_csv(string_to_find,csv_files):
+    right_csv=None
+    for f in csv_files:
+        if string_to_find in open(f).read():
+            right_csv=f
+    return right_csv
+
+
+def get_right_line(csvfile, srchstring):
+    right_line=None
+    reader = csv.reader(open(csvfile, 'r'))
+    for data in reader:
+        if any(srchstring in s for s in data):
+            right_line=data
+    return right_line
+
+
+def reset_dir(path):
+    shutil.rmtree(path, ignore_errors=True)
+    os.makedirs(path)
+
+
+def stage_benchmarks(data, work_dir, repeat, threads):
+    stages = {}
+    out = os.path.join(work_dir, "stage_output")
+    reset_dir(out)
+    stages["catalogue_refresh_cold"] = timed(lambda: (reset_dir(out), amp.prepare_datafiles(data["catalogue_tgz"], out).close()), repeat)
+    stages["catalogue_refresh_warm"] = timed(lambda: amp.prepare_datafiles(data["catalogue_tgz"], out).close(), repeat)
+    catalogue = amp.prepare_datafiles(data["catalogue_tgz"], out)
+    ids = data["product_ids"]
+    stages["catalogue_lookup"] = timed(lambda: [amp.lookup_product(catalogue, pid) for pid in ids], repeat, len(ids))
+    csv_files = [os.path.join(data["catalogue_dir"], f) for f in os.listdir(data["catalogue_dir"])]
+    legacy_ids = ids[:5]
+    stages["legacy_csv_scan"] = timed(lambda: [get_right_line(find_right_csv(pid, csv_files), pid) for pid in legacy_ids], 1, len(legacy_ids))
+    index_dir = os.path.join(out, "tgz_index")
+    for layout, paths in data["products"].items():
+        def inspect(theline_from_catalogue):
+            for path in paths:
+                img = amp.get_right_img_dir(path)
+                img, full_img_path, dest_dir, unzipped = amp.handle_zipped_input(img)
+                productid = img[:-4] if os.path.splitext(img)[-1] in amp.zipped else img
+                theline = amp.lookup_product(catalogue, productid) if theline_from_catalogue else None
+                if theline_from_catalogue and theline == None:
+                    continue
+                amp.inspect_product(productid, full_img_path, theline, None, False, amp.header_bytes, index_dir)
+        stages["inspect_" + layout] = timed(lambda: inspect(True), repeat, len(paths))
+        if layout != "shrk":
+            stages["read_ief_" + layout] = timed(lambda: inspect(False), repeat, len(paths))
+    dirs = data["products"].get("dir", [])
+    tar_out = os.path.join(work_dir, "tar_output")
+    for name, level, n in ("make_tarfile", 9, 1), ("make_tarfile_threads", 9, threads), ("make_tarfile_level1", 1, 1), ("make_tarfile_plain", None, 1):
+        stages[name] = timed(lambda: (reset_dir(tar_out), [amp.make_tarfile(os.path.join(tar_out, os.path.basename(d) + ".tgz"), d, level, n) for d in dirs]), repeat, len(dirs))
+    return stages
+
+
+def end_to_end_benchmarks(data, work_dir, repeat):
+    runs = {}
+    out = os.path.join(work_dir, "run_output")
+    reset_dir(out)
+    base = [sys.executable, parser_script, "--output", out, "--noaa_mtd", data["catalogue_tgz"]]
+    n_products = sum(len(paths) for paths in data["products"].values())
+    # refresh the catalogue once, the runs below time the per-product work
+    subprocess.run(base, check=True, stdout=subprocess.DEVNULL)
+    for layout, paths in data["products"].items():
+        if paths:
+            runs["avhrr_file_" + layout] = timed_run(base + ["--avhrr_file", paths[0]], repeat)
+    runs["avhrr_list"] = timed_run(base + ["--avhrr_list", data["list"]], repeat, n_products)
+    runs["avhrr_list_batch_join"] = timed_run(base + ["--avhrr_list", data["list"], "--batch_join"], repeat, n_products)
+    runs["avhrr_list_prefetch"] = timed_run(base + ["--avhrr_list", data["list"], "--prefetch", "4"], repeat, n_products)
+    dat_list = os.path.join(work_dir, "dat_products.txt")
+    with open(dat_list, "w") as f:
+        f.writelines(path + "\n" for path in data["products"].get("dat", []))
+    runs["avhrr_list_d"] = timed_run(base + ["--avhrr_list", dat_list, "-d"], repeat, len(data["products"].get("dat", [])))
+    organized = os.path.join(work_dir, "organized_output")
+
+    def fresh_organized():
+        reset_dir(organized)
+        shutil.copy(os.path.join(out, "NOAA_sat_mtd.sqlite"), organized)
+    organize_base = [sys.executable, parser_script, "--output", organized, "--noaa_mtd", data["catalogue_tgz"]]
+    runs["avhrr_list_O"] = timed_run(organize_base + ["--avhrr_list", data["list"], "-O"], repeat, n_products, fresh_organized)
+    return runs
+
+
+def compare(old_file, new_file):
+    with open(old_file) as f:
+        old = json.load(f)
+    with open(new_file) as f:
+        new = json.load(f)
+    print("%-28s %12s %12s %8s" % ("stage", old["commit"], new["commit"], "ratio"))
+    for group in "stages", "end_to_end":
+        for name in sorted(set(old[group]) | set(new[group])):
+            a = old[group].get(name, {}).get("wall")
+            b = new[group].get(name, {}).get("wall")
+            ratio = "%.2fx" % (b / a) if a and b else "-"
+            print("%-28s %12s %12s %8s" % (name, "%.4f" % a if a else "-", "%.4f" % b if b else "-", ratio))
+
+
+if __name__ == '__main__':
+    args = setup_cmd_args()
+    if args.compare:
+        compare(*args.compare)
+        sys.exit(0)
+    work_dir = args.work_dir or tempfile.mkdtemp(prefix="avhrr_bench_")
+    data = synthetic_data.generate(os.path.join(work_dir, "data"), args.catalogue_rows, products=args.products,
+                                   product_size=args.product_size)
+    results = {"commit": git_commit(), "date": datetime.datetime.now().isoformat(),
+               "params": {"catalogue_rows": args.catalogue_rows, "products": args.products,
+                          "product_size": args.product_size, "repeat": args.repeat},
+               "stages": stage_benchmarks(data, work_dir, args.repeat, args.threads),
+               "end_to_end": end_to_end_benchmarks(data, work_dir, args.repeat)}
+    os.makedirs(args.results_dir, exist_ok=True)
+    results_file = os.path.join(args.results_dir, results["commit"] + "_" + datetime.datetime.now().strftime('%Y%m%d%H%M%S') + ".json")
+    with open(results_file, "w") as f:
+        json.dump(results, f, indent=1)
+    for group in "stages", "end_to_end":
+        for name, timing in results[group].items():
+            print("%-28s wall=%.4fs cpu=%.4fs ops=%d" % (name, timing["wall"], timing["cpu"], timing["ops"]))
+    print("results=" + results_file)
+    if not args.work_dir:
+        shutil.rmtree(work_dir)
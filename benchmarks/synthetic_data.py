@@ -0,0 +1,149 @@
+import os
+import io
+import csv
+import random
+import shutil
+import argparse
+import datetime
+import tarfile
+import zipfile
+
+
+layouts = ["dir", "shrk", "dat", "zip", "tgz"]
+stations = ["TROMSO  STN", "MASPALOMAS", "KIRUNA", "HOBART", "TSN"]
+
+
+def setup_cmd_args():
+    """Setup command line arguments."""
+    parser = argparse.ArgumentParser(description="Generate a synthetic NOAA catalogue and AVHRR products for benchmarking avhrr_metadata_parser.", formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument("dst_dir", help="Folder to write the synthetic data into (emptied first)")
+    parser.add_argument("--catalogue_rows", type=int, default=100000, help="Number of passes in the catalogue")
+    parser.add_argument("--catalogue_files", type=int, default=20, help="Number of catalogue CSV files")
+    parser.add_argument("--products", type=int, default=10, help="Number of products per layout")
+    parser.add_argument("--layouts", default=",".join(layouts), help="Comma separated product layouts to generate")
+    parser.add_argument("--product_size", type=int, default=1 << 20, help="Bytes of image data per product")
+    parser.add_argument("--leader_size", type=int, default=256 * 1024, help="Bytes of each LEADER file")
+    parser.add_argument("--nofp", type=float, default=0.05, help="Fraction of passes without footprint")
+    parser.add_argument("--seed", type=int, default=0, help="Random seed")
+    return parser.parse_args()
+
+
+def product_id(date, station):
+    return date.strftime('%y%m%d%H%M') + station[:3].upper() + str(random.randint(1, 9))
+
+
+def catalogue_line(pid, date, station, level, footprint):
+    """A catalogue row with the columns the parser reads as theline[0..8]."""
+    stop = date + datetime.timedelta(minutes=random.randint(5, 15))
+    corners = ''
+    if footprint:
+        lat, lon = random.uniform(-80, 70), random.uniform(-180, 170)
+        corners = " ".join("%.3f" % v for v in (lat, lon, lat, lon + 10, lat + 10, lon + 10, lat + 10, lon))
+    return [pid, date.strftime('%y%m%d'), date.strftime('%H%M%S'), stop.strftime('%H%M%S'), "AVHRR",
+            station, "%05d" % random.randint(0, 99999), level, corners]
+
+
+def ief_text(line):
+    return "CAT IEF AVHRR NOAA GAC %s 1B %s %s %s %s \n" % (line[5][:3], line[6], line[1], line[2], line[3])
+
+
+def leader_bytes(size, level):
+    header = ("LEADER FILE PROCESSING LEVEL " + level + "\n").encode()
+    return header + b"\0" * max(0, size - len(header))
+
+
+def write_catalogue(dst_dir, lines, files):
+    csv_dir = os.path.join(dst_dir, "Noaa_catalogue_1_1")
+    os.makedirs(csv_dir)
+    per_file = -(-len(lines) // files)
+    for i in range(files):
+        with open(os.path.join(csv_dir, "noaa_%02d.csv" % i), "w", newline='') as f:
+            csv.writer(f).writerows(lines[i * per_file:(i + 1) * per_file])
+    with tarfile.open(os.path.join(dst_dir, "Noaa_catalogue_1_1.tgz"), "w:gz") as tar:
+        tar.add(csv_dir, arcname="Noaa_catalogue_1_1")
+    return csv_dir
+
+
+def product_members(pid, line, layout, product_size, leader_size):
+    """(name, bytes) of the files making a product of the given layout."""
+    level = random.choice(["1A", "1B"])
+    image = random.randbytes(product_size // 2) + b"\0" * (product_size - product_size // 2)
+    if layout == "dat":
+        return [(pid + ".dat", image), (pid + ".ief", ief_text(line).encode())]
+    members = [(pid + ".l1a", image), (pid + ".ief", ief_text(line).encode()),
+               ("LEADER", leader_bytes(leader_size, "LEVEL " + level))]
+    if layout in ("zip", "tgz"):
+        members.append(("catalogue.ief", ("LEVEL " + level + "\n").encode()))
+    return members
+
+
+def write_product(products_dir, pid, members, layout):
+    if layout == "zip":
+        path = os.path.join(products_dir, pid + ".zip")
+        with zipfile.ZipFile(path, "w", zipfile.ZIP_DEFLATED) as archive:
+            for name, data in members:
+                archive.writestr(name, data)
+    elif layout == "tgz":
+        path = os.path.join(products_dir, pid + ".tgz")
+        with tarfile.open(path, "w:gz") as tar:
+            for name, data in members:
+                info = tarfile.TarInfo(name)
+                info.size = len(data)
+                tar.addfile(info, io.BytesIO(data))
+    else:
+        path = os.path.join(products_dir, pid + (".SHRK" if layout == "shrk" else ""))
+        folder = os.path.join(path, pid) if layout == "shrk" else path
+        os.makedirs(folder)
+        for name, data in members:
+            with open(os.path.join(folder, name), "wb") as f:
+                f.write(data)
+    return path
+
+
+def generate(dst_dir, catalogue_rows=100000, catalogue_files=20, products=10, product_layouts=layouts,
+             product_size=1 << 20, leader_size=256 * 1024, nofp=0.05, seed=0):
+    '''Write a catalogue (CSV folder and tgz), products of every layout listed in
+    it and a products list into dst_dir. Returns a dict of the generated paths.'''
+    random.seed(seed)
+    shutil.rmtree(dst_dir, ignore_errors=True)
+    os.makedirs(dst_dir)
+    lines = []
+    seen = set()
+    date = datetime.datetime(1993, 1, 1)
+    while len(lines) < catalogue_rows:
+        date += datetime.timedelta(minutes=random.randint(1, 30))
+        pid = product_id(date, random.choice(stations))
+        if pid in seen:
+            continue
+        seen.add(pid)
+        lines.append(catalogue_line(pid, date, random.choice(stations), random.choice(["", "1B", "L1A"]),
+                                    random.random() >= nofp))
+    picked = random.sample(lines, min(len(lines), products * len(product_layouts)))
+    for i, line in enumerate(picked):
+        if product_layouts[i % len(product_layouts)] == "shrk":
+            # the parser looks .SHRK folders up by their full name
+            line[0] += ".SHRK"
+    csv_dir = write_catalogue(dst_dir, lines, catalogue_files)
+    products_dir = os.path.join(dst_dir, "products")
+    os.makedirs(products_dir)
+    paths = dict((layout, []) for layout in product_layouts)
+    for i, line in enumerate(picked):
+        layout = product_layouts[i % len(product_layouts)]
+        pid = line[0].replace(".SHRK", "")
+        members = product_members(pid, line, layout, product_size, leader_size)
+        paths[layout].append(write_product(products_dir, pid, members, layout))
+    list_file = os.path.join(dst_dir, "products.txt")
+    with open(list_file, "w") as f:
+        for layout in product_layouts:
+            for path in paths[layout]:
+                f.write(path + "\n")
+    return {"catalogue_dir": csv_dir, "catalogue_tgz": os.path.join(dst_dir, "Noaa_catalogue_1_1.tgz"),
+            "products": paths, "product_ids": [line[0] for line in picked], "list": list_file}
+
+
+if __name__ == '__main__':
+    args = setup_cmd_args()
+    generated = generate(args.dst_dir, args.catalogue_rows, args.catalogue_files, args.products,
+                         args.layouts.split(","), args.product_size, args.leader_size, args.nofp, args.seed)
+    print("catalogue=" + generated["catalogue_tgz"])
+    print("list=" + generated["list"])